@@ -7,25 +7,35 @@ assumptions of Fisher's method, which assumes only that the p-values input are
 drawn from a uniform distribution.
 """
 
-from os import path
+from os import path, makedirs, replace, getpid, stat
+from sys import exit
 from argparse import ArgumentParser
-from multiprocessing import Pool
+from multiprocessing.pool import ThreadPool
 from collections import defaultdict
 import pandas as pd
 import numpy as np
-import itertools as it
-from numpy import log10, nan, isfinite
-from scipy.stats import combine_pvalues
-import matplotlib.pyplot as mpl
-import pickle as pkl
-from numpy.random import shuffle, rand
+from scipy.stats import chi2
 from tqdm import tqdm
 from PlotCombinedPvals import (
-    make_qq_plot,
     make_tehranchigram,
-    make_manhattan_plot,
     plot_top_snps,
+    FET_COLUMNS,
+    FET_INT_COLUMNS,
 )
+from SharedPool import shared_pool, worker_state
+from ParseCache import MAX_CACHE_BYTES, cache_key, load_entry, save_entry
+
+SCORE_DTYPES = {
+    "snp_id": str,
+    "pval": float,
+    "stalk_ref": np.int32,
+    "stalk_alt": np.int32,
+    "spore_ref": np.int32,
+    "spore_alt": np.int32,
+    "stalk_ratio": float,
+    "spore_ratio": float,
+    "rank": np.int32,
+}
 
 
 def parse_args():
@@ -39,192 +49,707 @@ def parse_args():
         action="store_true",
         help="This is intended for situations where I'm tweaking"
         " the parameters of the ancillary plots and want to see the"
-        " results more quickly",
+        " results more quickly. Nothing but the plots gets written, and with"
+        " --cache-dir, the scores and combined p-values come from the cache.",
     )
     parser.add_argument("--autosomes", nargs="*")
+    parser.add_argument(
+        "--cache-dir",
+        default=None,
+        help="Directory to cache the parsed scores and the combined and"
+        " permutation p-values in, keyed by the contents of the scores files and"
+        " the parameters, so reruns that only change the plots skip all that."
+        " Once it holds more than {} GB, the least recently used entries are"
+        " removed".format(MAX_CACHE_BYTES // 2**30),
+    )
+    parser.add_argument(
+        "--permutations",
+        type=int,
+        default=0,
+        help="Number of seeded shuffles of every sample to build an empirical"
+        " null from. With 0, there's only the single Random shuffle.",
+    )
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument(
+        "--fdr",
+        type=float,
+        default=0.05,
+        help="False discovery rate to pick the permutation p-value cutoff at",
+    )
+    parser.add_argument("--threads", "-t", type=int, default=1)
+    parser.add_argument(
+        "--memory-budget",
+        type=float,
+        default=2,
+        help="Gigabytes to use for the permutations, across all threads",
+    )
+    parser.add_argument(
+        "--aggregates",
+        default=None,
+        help="File to keep the running per-SNP sums in, so that new samples can"
+        " be added with --incremental",
+    )
+    parser.add_argument(
+        "--incremental",
+        default=False,
+        action="store_true",
+        help="Only fold the scores files that aren't in --aggregates yet into"
+        " the running sums, and write out just the combined tables",
+    )
+    parser.add_argument(
+        "--region",
+        action="append",
+        default=[],
+        help="Only combine the SNPs in this region (CHROM or CHROM:START-END,"
+        " 1-based), and skip the plots. Ranks are still normalized over the"
+        " whole genome, so MergeCombinedPvals.py can put shards back together."
+        " Can be given more than once.",
+    )
+    parser.add_argument(
+        "--chrom",
+        action="append",
+        default=[],
+        help="Same as --region, for a whole chromosome",
+    )
+    parser.add_argument(
+        "--fullrep",
+        default=None,
+        help="Where to save the ratios of the SNPs that are good in every sample"
+        " (default: fullrep_snps.tsv, next to the output prefix)",
+    )
     parser.add_argument("scores", nargs="+")
 
     parsed_args = parser.parse_args()
+    if parsed_args.incremental and parsed_args.aggregates is None:
+        parser.error("--incremental needs an --aggregates file")
+    parsed_args.regions = [
+        parse_region(region) for region in parsed_args.region + parsed_args.chrom
+    ]
+    if parsed_args.regions and (parsed_args.incremental or parsed_args.permutations):
+        parser.error("Sharded runs can't be incremental or run permutations")
+    if parsed_args.regions and parsed_args.aggregates is not None:
+        # A shard's sums only cover its regions, but they'd be saved as if they
+        # covered every SNP in the scores files, and --incremental trusts that
+        parser.error("Sharded runs can't save --aggregates")
     return parsed_args
 
 
-def load_data(filenames):
-    "Load SNP scores"
-    # To-do: make the returns more organized.
-    pvals_to_combine_fwd = defaultdict(list)
-    pvals_to_combine_rev = defaultdict(list)
-    pvals_to_combine_rand = defaultdict(list)
+def parse_region(region):
+    "Split CHROM or CHROM:START-END (1-based, inclusive) into chrom, start, stop"
+    chrom, _, span = region.partition(":")
+    if not span:
+        return chrom, 0, np.inf
+    start, stop = span.replace(",", "").split("-")
+    return chrom, int(start), int(stop)
+
+
+def in_regions(snps, regions):
+    "Which of the SNP ids (CHROM:POS_REF|ALT) fall in any of the regions"
+    chrom_of = np.array([snp.split(":", 1)[0] for snp in snps], dtype=str)
+    keep = np.zeros(len(snps), dtype=bool)
+    for chrom, start, stop in regions:
+        on_chrom = chrom_of == chrom
+        if start > 0 or np.isfinite(stop):
+            pos = np.array(
+                [int(snp.split(":", 1)[1].split("_", 1)[0]) for snp in snps[on_chrom]],
+                dtype=np.int64,
+            )
+            on_chrom[on_chrom] = (start <= pos) & (pos <= stop)
+        keep |= on_chrom
+    return keep
+
+
+def read_scores(fname):
+    "Read just the columns of a ScoreSnps.py output that get combined"
+    return pd.read_csv(
+        fname,
+        sep="\t",
+        index_col=0,
+        usecols=["snp_id", *FET_COLUMNS],
+        dtype=SCORE_DTYPES,
+    )
 
-    fet_data = {}
 
-    all_stalk_freqs = defaultdict(list)
-    all_spore_freqs = defaultdict(list)
-    stalk_ref_depth = None
-    spore_ref_depth = None
-    stalk_alt_depth = None
-    spore_alt_depth = None
+def extend_rows(table, num_rows, fill):
+    "Pad out a table with rows of fill, for SNPs that weren't seen before"
+    # Column-major, so that filling in one file's column stays in cache
+    out = np.full((num_rows, *table.shape[1:]), fill, dtype=table.dtype, order="F")
+    out[: len(table)] = table
+    return out
 
-    print("Processing input files")
-    for file in tqdm(filenames):
-        fet_file = pd.read_csv(file, squeeze=True, index_col=0, sep="\t")
-        if stalk_ref_depth is None:
-            stalk_ref_depth = fet_file.stalk_ref
-            spore_ref_depth = fet_file.spore_ref
-            stalk_alt_depth = fet_file.stalk_alt
-            spore_alt_depth = fet_file.spore_alt
-        else:
-            stalk_ref_depth += fet_file.stalk_ref
-            spore_ref_depth += fet_file.spore_ref
-            stalk_alt_depth += fet_file.stalk_alt
-            spore_alt_depth += fet_file.spore_alt
-
-        fet_data[file] = fet_file.sort_index()
-        good_snps = isfinite(fet_file["rank"]) & (fet_file["rank"] >= 0)
-        fet_file = fet_file.loc[good_snps]
-        great_snps = (fet_file.iloc[:, 1:3].T.sum() > 10) & (
-            fet_file.iloc[:, 3:5].T.sum() > 10
+
+def read_shard(task):
+    """Read one scores file, keeping only the SNPs in the given regions
+
+    The pseudo p-values are normalized by the highest rank in the whole file,
+    and the random set is shuffled across the whole file with its own seed, so
+    a shard comes out exactly the same as that part of a whole-genome run.
+
+    Output: the scores for the SNPs in the shard, the highest rank, and the
+    shuffled pseudo p-values for the SNPs in the shard.
+    """
+    fname, seed, regions = task
+    fet_file = read_scores(fname)
+    rank = fet_file["rank"].values
+    good_snps = rank >= 0
+    maxrank = rank.max()
+
+    semi_ps_rand = rank[good_snps] / maxrank
+    np.random.RandomState(seed).shuffle(semi_ps_rand)
+    rand_ps = np.full(len(rank), np.nan)
+    rand_ps[good_snps] = semi_ps_rand
+
+    if regions:
+        in_shard = in_regions(fet_file.index, regions)
+        fet_file = fet_file.loc[in_shard]
+        rand_ps = rand_ps[in_shard]
+    return fet_file, maxrank, rand_ps
+
+
+def load_data(filenames, threads=1, regions=None, seed=0):
+    """Load SNP scores into SNP x sample tables
+
+    The files are parsed on a pool of threads, and each one is slotted into its
+    own column of tables that all share one master SNP index. SNPs that one
+    file has and the others don't just get a missing value in the others'
+    columns. The master index is sorted once everything is loaded. If regions
+    are given, only the SNPs in them are kept (see read_shard).
+    """
+    # To-do: make the returns more organized.
+    num_files = len(filenames)
+    snps = pd.Index([])
+    fills = {
+        "fwd": np.nan,
+        "rev": np.nan,
+        "rand": np.nan,
+        **{column: np.nan for column in FET_COLUMNS},
+        **{column: -1 for column in FET_INT_COLUMNS},
+    }
+    tables = {
+        name: np.zeros(
+            (0, num_files), dtype=np.int32 if name in FET_INT_COLUMNS else float
         )
-        if "any_good_snps" not in locals():
-            any_good_snps = good_snps * 0
-        any_good_snps += good_snps
-
-        for ix in fet_file.loc[great_snps].index:
-            chr = ix.split(":")[0]
-            all_stalk_freqs[chr].append(fet_file.loc[ix, "stalk_ratio"])
-            all_spore_freqs[chr].append(fet_file.loc[ix, "spore_ratio"])
-
-        maxrank = fet_file["rank"].max()
-        semi_ps = fet_file["rank"] / maxrank
-
-        # Shuffling a Series is apparently wicked slow
-        semi_ps_rand_to_shuffle = np.array(semi_ps[good_snps])
-        shuffle(semi_ps_rand_to_shuffle)
-        semi_ps_rand = pd.Series(index=semi_ps.index, data=np.nan)
-        semi_ps_rand[good_snps] = semi_ps_rand_to_shuffle
-
-        for ix in semi_ps.index:
-            pvals_to_combine_fwd[ix].append(semi_ps[ix])
-            pvals_to_combine_rev[ix].append(
-                1 - semi_ps[ix] + 1 / fet_file["rank"].max()
-            )
-            pvals_to_combine_rand[ix].append(semi_ps_rand[ix])
+        for name in fills
+    }
+    depths = {
+        name: np.zeros(0, dtype=np.int64)
+        for name in ["stalk_ref", "spore_ref", "stalk_alt", "spore_alt"]
+    }
+
+    print("Processing input files")
+    tasks = [(fname, [seed, i], regions) for i, fname in enumerate(filenames)]
+    with ThreadPool(threads) as pool:
+        for i, (fet_file, maxrank, rand_ps) in enumerate(
+            tqdm(pool.imap(read_shard, tasks), total=num_files)
+        ):
+            rows = snps.get_indexer(fet_file.index)
+            new_snps = rows < 0
+            if new_snps.any():
+                rows[new_snps] = len(snps) + np.arange(new_snps.sum())
+                snps = snps.append(fet_file.index[new_snps])
+                for name in tables:
+                    tables[name] = extend_rows(tables[name], len(snps), fills[name])
+                for name in depths:
+                    depths[name] = extend_rows(depths[name], len(snps), 0)
+
+            for column in FET_COLUMNS:
+                tables[column][rows, i] = fet_file[column].values
+            for name in depths:
+                depths[name][rows] += fet_file[name].values
+
+            rank = fet_file["rank"].values
+            good_snps = rank >= 0
+            semi_ps = rank[good_snps] / maxrank
+
+            tables["fwd"][rows[good_snps], i] = semi_ps
+            tables["rev"][rows[good_snps], i] = 1 - semi_ps + 1 / maxrank
+            tables["rand"][rows, i] = rand_ps
+
+    order = snps.argsort()
+    snps = snps[order].rename("snp_id")
+    for name in tables:
+        tables[name] = tables[name][order]
+    for name in depths:
+        depths[name] = pd.Series(index=snps, data=depths[name][order])
+
+    any_good_snps = pd.Series(index=snps, data=(tables["rank"] >= 0).sum(axis=1))
+
+    all_stalk_freqs, all_spore_freqs = allele_freqs(snps, tables)
+
+    fet_data = {column: tables[column] for column in FET_COLUMNS}
+    fet_data["snps"] = snps
+    fet_data["samples"] = list(filenames)
 
     return (
-        pvals_to_combine_fwd,
-        pvals_to_combine_rev,
-        pvals_to_combine_rand,
+        pd.DataFrame(tables["fwd"], index=snps, columns=filenames),
+        pd.DataFrame(tables["rev"], index=snps, columns=filenames),
+        pd.DataFrame(tables["rand"], index=snps, columns=filenames),
         all_stalk_freqs,
         all_spore_freqs,
-        pd.Series(stalk_ref_depth),
-        pd.Series(spore_ref_depth),
-        pd.Series(stalk_alt_depth),
-        pd.Series(spore_alt_depth),
+        depths["stalk_ref"],
+        depths["spore_ref"],
+        depths["stalk_alt"],
+        depths["spore_alt"],
         any_good_snps,
         fet_data,
     )
 
 
-def load_data_single(fname):
-    fet_file_orig = pd.read_csv(fname, sep="\t", squeeze=True, index_col=0)
+def allele_freqs(snps, fet_data):
+    """Alt allele frequencies of the well-covered, ranked SNPs on each chromosome
 
-    good_snps = isfinite(fet_file_orig["rank"]) & (fet_file_orig["rank"] >= 0)
-    fet_file = fet_file_orig.loc[good_snps]
+    Output: dictionaries of stalk and spore frequencies by chromosome, for the
+    tehranchigrams.
+    """
+    all_stalk_freqs = defaultdict(list)
+    all_spore_freqs = defaultdict(list)
+    great_snps = (
+        (fet_data["rank"] >= 0)
+        & (fet_data["stalk_ref"] + fet_data["stalk_alt"] > 10)
+        & (fet_data["spore_ref"] + fet_data["spore_alt"] > 10)
+    )
+    chrom_codes, chroms = pd.factorize(
+        np.asarray([snp.split(":", 1)[0] for snp in snps])
+    )
+    for code, chrom in enumerate(chroms):
+        on_chrom = great_snps & (chrom_codes == code)[:, np.newaxis]
+        # Transposed to keep them grouped by file
+        all_stalk_freqs[chrom] = fet_data["stalk_ratio"].T[on_chrom.T]
+        all_spore_freqs[chrom] = fet_data["spore_ratio"].T[on_chrom.T]
+    return all_stalk_freqs, all_spore_freqs
+
+
+DEPTH_NAMES = [
+    "stalk_ref_depth",
+    "spore_ref_depth",
+    "stalk_alt_depth",
+    "spore_alt_depth",
+]
+COMBINED_NAMES = ["combined_fwd", "combined_rev", "combined_rand"]
+
+
+def pack_parsed(parsed, combined_pvals):
+    "Arrays to cache the output of load_data and the combined p-values as"
+    fet_data = parsed[10]
+    snps = fet_data["snps"]
+    arrays = {column: fet_data[column] for column in FET_COLUMNS}
+    arrays["snps"] = np.array(snps, dtype=bytes)
+    arrays["samples"] = np.array(fet_data["samples"], dtype=str)
+    for name, table in zip(["pvals_fwd", "pvals_rev", "pvals_rand"], parsed[:3]):
+        arrays[name] = table.values
+    for name, depth in zip(DEPTH_NAMES, parsed[5:9]):
+        arrays[name] = depth.values
+    arrays["num_snps"] = parsed[9].values
+    for name, pvals in zip(COMBINED_NAMES, combined_pvals):
+        arrays[name] = pvals.reindex(snps).values
+    return arrays
+
+
+def unpack_parsed(entry):
+    "Rebuild the output of load_data and the combined p-values from the cache"
+    snps = pd.Index(entry["snps"].astype(str), name="snp_id")
+    samples = entry["samples"].tolist()
+    fet_data = {column: entry[column] for column in FET_COLUMNS}
+    fet_data["snps"] = snps
+    fet_data["samples"] = samples
+    any_good_snps = pd.Series(index=snps, data=entry["num_snps"])
+    good_snps = any_good_snps.values > 0
+
+    parsed = (
+        *(
+            pd.DataFrame(entry[name], index=snps, columns=samples)
+            for name in ["pvals_fwd", "pvals_rev", "pvals_rand"]
+        ),
+        *allele_freqs(snps, fet_data),
+        *(pd.Series(index=snps, data=entry[name]) for name in DEPTH_NAMES),
+        any_good_snps,
+        fet_data,
+    )
+    combined_pvals = [
+        pd.Series(index=snps[good_snps], data=entry[name][good_snps])
+        for name in COMBINED_NAMES
+    ]
+    return parsed, combined_pvals
+
+
+def fullrep_table(fet_data, snps):
+    "Spore and stalk alt ratios in every sample, for SNPs that are in the store"
+    rows = fet_data["snps"].get_indexer(snps)
+    samples = fet_data["samples"]
+    return pd.DataFrame(
+        np.hstack([fet_data["spore_ratio"][rows], fet_data["stalk_ratio"][rows]]),
+        index=snps,
+        columns=[sample + "_spore" for sample in samples]
+        + [sample + "_stalk" for sample in samples],
+    )
 
-    maxrank = fet_file["rank"].max()
-    semi_ps = fet_file["rank"] / maxrank
 
-    # Shuffling a Series is apparently wicked slow
-    semi_ps_rand_to_shuffle = np.array(semi_ps[good_snps])
-    shuffle(semi_ps_rand_to_shuffle)
-    semi_ps_rand = pd.Series(index=semi_ps.index, data=np.nan)
-    semi_ps_rand[good_snps] = semi_ps_rand_to_shuffle
+def write_fet_store(dirname, fet_data):
+    """Save the per-sample FET results as memory-mappable SNP x sample arrays
 
-    return dict(
-        fet=fet_file_orig.sort_index(),
-        good_snps=good_snps,
-        semi_ps=semi_ps,
-        rand_ps=semi_ps_rand,
-        max_rank=fet_file["rank"].max(),
-    )
+    There's one .npy file per column, plus the sorted SNP ids and the sample
+    names, so that readers can pull out just the SNPs they need (see
+    load_fet_store).
+    """
+    makedirs(dirname, exist_ok=True)
+    np.save(path.join(dirname, "snps.npy"), np.array(fet_data["snps"], dtype=bytes))
+    np.save(path.join(dirname, "samples.npy"), np.array(fet_data["samples"], dtype=str))
+    for column in FET_COLUMNS:
+        np.save(path.join(dirname, column + ".npy"), fet_data[column])
 
 
-def load_data_multi(files):
+def combine_all_pvals(table, indices):
+    """Fisher's method on every row of a SNP x sample table of p-values
+
+    Missing (NaN) p-values are left out of that SNP's combination, so each row
+    gets 2 degrees of freedom per sample that actually has a p-value.
+    """
+    to_combine = table.index.isin(indices)
+    pvals = table.values[to_combine]
+
+    with np.errstate(divide="ignore"):
+        statistic = -2 * np.nansum(np.log(pvals), axis=1)
+    dof = 2 * np.isfinite(pvals).sum(axis=1)
+
+    return pd.Series(index=table.index[to_combine], data=chi2.sf(statistic, dof))
+
+
+def sample_shuffles(seed, permutations, sample, size):
+    """Shuffled orders of one sample's p-values, for a block of permutations
+
+    Every (permutation, sample) pair gets its own seed, so a permutation comes
+    out the same no matter how the permutations are split into blocks.
+    """
+    orders = np.empty((len(permutations), size), dtype=np.intp)
+    for i, permutation in enumerate(permutations):
+        random_state = np.random.RandomState([seed, permutation, sample])
+        orders[i] = random_state.permutation(size)
+    return orders
+
+
+def permutation_null_counts(permutations):
+    """Count where a block of permutations' combined p-values fall, in a worker
+
+    Output: a histogram over the sorted observed p-values, so that its
+    cumulative sum is the number of null p-values at or below each of them.
+    """
+    observed = worker_state["observed"]
+    dof = worker_state["dof"]
+    bounds = worker_state["sample_bounds"]
+    stat_fwd = np.zeros((len(permutations), len(dof)))
+    stat_rev = np.zeros((len(permutations), len(dof)))
+    for sample, (start, stop) in enumerate(zip(bounds, bounds[1:])):
+        rows = worker_state["rows"][start:stop]
+        order = sample_shuffles(worker_state["seed"], permutations, sample, len(rows))
+        stat_fwd[:, rows] += worker_state["logs_fwd"][start:stop][order]
+        stat_rev[:, rows] += worker_state["logs_rev"][start:stop][order]
+
+    counts = np.zeros(len(observed) + 1, dtype=np.int64)
+    for statistic in (stat_fwd, stat_rev):
+        null = chi2.sf(statistic, dof).ravel()
+        counts += np.bincount(observed.searchsorted(null), minlength=len(counts))
+    return counts
+
+
+def permutation_pvals(
+    pvals_fwd,
+    pvals_rev,
+    combined_fwd,
+    combined_rev,
+    num_permutations,
+    seed=0,
+    fdr=0.05,
+    threads=1,
+    memory_budget=2 * 2**30,
+):
+    """Empirical p-values for the combined p-values, from shuffling each sample
+
+    Each permutation shuffles every sample's pseudo p-values among the SNPs that
+    sample has a rank for, just like the Random set, and combines them with
+    Fisher's method. The null p-values from every SNP, both directions, and all
+    the permutations are pooled, and only their counts relative to the observed
+    p-values are kept. Permutations are run in blocks that all fit in
+    memory_budget bytes at once.
+
+    Output: a table of empirical p-values and q-values for each direction, and
+    a combined p-value cutoff (as in params/pval_cutoff) for the given FDR.
+    """
+    tested = combined_fwd.index[np.isfinite(combined_fwd)]
+    fwd = pvals_fwd.reindex(tested).values
+    rev = pvals_rev.reindex(tested).values
+    dof = 2 * np.isfinite(fwd).sum(axis=1)
+
+    # Each sample's tested rows and log p-values, one sample after another, so
+    # they can go in shared memory as just a few flat arrays
+    has_pval = np.isfinite(fwd.T)
+    samples, rows = np.nonzero(has_pval)
+    sample_bounds = np.concatenate([[0], has_pval.sum(axis=1).cumsum()])
+    logs_fwd = -2 * np.log(fwd[rows, samples])
+    logs_rev = -2 * np.log(rev[rows, samples])
+
+    observed_fwd = combined_fwd[tested].values
+    observed_rev = combined_rev[tested].values
+    observed = np.sort(np.concatenate([observed_fwd, observed_rev]))
+
+    # Roughly 8 arrays of float64s or int64s per SNP and permutation are alive
+    # at once in a block
+    block_size = memory_budget // (64 * max(len(tested), 1) * threads)
+    block_size = max(1, min(block_size, -(-num_permutations // threads)))
+    blocks = [
+        range(start, min(start + block_size, num_permutations))
+        for start in range(0, num_permutations, block_size)
+    ]
 
-    fet_data = {}
-    all_stalk_freqs = defaultdict(list)
-    all_spore_freqs = defaultdict(list)
-    stalk_ref_depth = None
-    spore_ref_depth = None
-    stalk_alt_depth = None
-    spore_alt_depth = None
-    any_good_snps = None
-    pvals_to_combine_fwd = defaultdict(list)
-    pvals_to_combine_rev = defaultdict(list)
-    pvals_to_combine_rand = defaultdict(list)
-
-    print("Dispatching files for reading")
-    p = Pool()
-    jobs = {fname: p.apply_async(load_data_single, (fname,)) for fname in tqdm(files)}
-
-    print("Collecting read files")
-    for ix in tqdm(jobs):
-        res = jobs[ix].get()
-        fet_file = res["fet"]
-        fet_data[ix] = fet_file
-        semi_ps = res["semi_ps"]
-        semi_ps_rand = res["rand_ps"]
-        max_rank = res["max_rank"]
-        good_snps = res["good_snps"]
-
-        if stalk_ref_depth is None:
-            stalk_ref_depth = fet_file.stalk_ref
-            spore_ref_depth = fet_file.spore_ref
-            stalk_alt_depth = fet_file.stalk_alt
-            spore_alt_depth = fet_file.spore_alt
-            any_good_snps = good_snps
-        else:
-            stalk_ref_depth += fet_file.stalk_ref
-            spore_ref_depth += fet_file.spore_ref
-            stalk_alt_depth += fet_file.stalk_alt
-            spore_alt_depth += fet_file.spore_alt
-            any_good_snps += good_snps
-
-        for ix in semi_ps.index:
-            pvals_to_combine_fwd[ix].append(semi_ps[ix])
-            pvals_to_combine_rev[ix].append(1 - semi_ps[ix] + 1 / max_rank)
-            pvals_to_combine_rand[ix].append(semi_ps_rand[ix])
-
-        great_snps = (fet_file.iloc[:, 1:3].T.sum() > 10) & (
-            fet_file.iloc[:, 3:5].T.sum() > 10
+    null_counts = np.zeros(len(observed) + 1, dtype=np.int64)
+    arrays = dict(
+        rows=rows,
+        sample_bounds=sample_bounds,
+        logs_fwd=logs_fwd,
+        logs_rev=logs_rev,
+        dof=dof,
+        observed=observed,
+    )
+    with shared_pool(threads, arrays, seed=seed) as pool:
+        for counts in tqdm(
+            pool.imap_unordered(permutation_null_counts, blocks), total=len(blocks)
+        ):
+            null_counts += counts
+    null_at_or_below = null_counts.cumsum()[:-1]
+
+    # Expected false discoveries over discoveries, with each observed p-value as
+    # the cutoff
+    observed_at_or_below = observed.searchsorted(observed, side="right")
+    fdrs = null_at_or_below / num_permutations / observed_at_or_below
+    qvals = np.minimum(1, np.minimum.accumulate(fdrs[::-1])[::-1])
+
+    out = pd.DataFrame(index=tested)
+    num_null = 2 * len(tested) * num_permutations
+    for name, pvals in (("spore", observed_fwd), ("stalk", observed_rev)):
+        ix = observed.searchsorted(pvals, side="right") - 1
+        out[name + "_empirical"] = (1 + null_at_or_below[ix]) / (1 + num_null)
+        out[name + "_qval"] = qvals[ix]
+
+    passing = observed[qvals <= fdr]
+    # The cutoff gets used as "pval < cutoff", so nudge it past the last SNP
+    cutoff = np.nextafter(passing.max(), 1) if len(passing) else 0.0
+    return out, cutoff
+
+
+PERMUTATION_COLUMNS = ["spore_empirical", "spore_qval", "stalk_empirical", "stalk_qval"]
+
+
+def cached_permutation_pvals(cache_dir, key, *args, **kwargs):
+    "permutation_pvals, but only run once for each key if there's a cache_dir"
+    cached = load_entry(cache_dir, key)
+    if cached is not None:
+        print("Loading permutations from the cache")
+        out = pd.DataFrame(
+            {name: cached[name] for name in PERMUTATION_COLUMNS},
+            index=pd.Index(cached["snps"].astype(str), name="snp_id"),
+        )
+        return out, float(cached["cutoff"])
+
+    out, cutoff = permutation_pvals(*args, **kwargs)
+    if cache_dir is not None:
+        arrays = {name: out[name].values for name in PERMUTATION_COLUMNS}
+        arrays["snps"] = np.array(out.index, dtype=bytes)
+        arrays["cutoff"] = np.array(cutoff)
+        save_entry(cache_dir, key, arrays)
+    return out, cutoff
+
+
+AGGREGATE_COLUMNS = [
+    "spore_stat",
+    "stalk_stat",
+    "random_stat",
+    "num_snps",
+    "stalk_ref_depth",
+    "spore_ref_depth",
+    "stalk_alt_depth",
+    "spore_alt_depth",
+]
+AGGREGATE_COUNTS = {column: np.int64 for column in AGGREGATE_COLUMNS[3:]}
+
+
+def file_fingerprint(fname):
+    "Size and modification time, to tell if a scores file has changed"
+    fstat = stat(fname)
+    return fstat.st_size, fstat.st_mtime
+
+
+def load_aggregates(fname):
+    """Load the running per-SNP sums from earlier runs
+
+    Output: a DataFrame with the AGGREGATE_COLUMNS for each SNP, and a
+    dictionary of the fingerprints of the scores files already summed in.
+    """
+    if not path.exists(fname):
+        return pd.DataFrame(columns=AGGREGATE_COLUMNS, dtype=float), {}
+    data = np.load(fname)
+    aggregates = pd.DataFrame(
+        {column: data[column] for column in AGGREGATE_COLUMNS},
+        index=pd.Index(data["snps"].astype(str), name="snp_id"),
+    )
+    folded = {
+        fname: (size, mtime)
+        for fname, size, mtime in zip(
+            data["samples"].tolist(), data["sizes"].tolist(), data["mtimes"].tolist()
+        )
+    }
+    return aggregates, folded
+
+
+def save_aggregates(fname, aggregates, folded):
+    "Save the running per-SNP sums, moving them into place once written"
+    if path.dirname(fname):
+        makedirs(path.dirname(fname), exist_ok=True)
+    tmp_fname = "{}.{}.tmp".format(fname, getpid())
+    with open(tmp_fname, "wb") as outfh:
+        np.savez(
+            outfh,
+            snps=np.array(aggregates.index, dtype=bytes),
+            samples=np.array(list(folded), dtype=str),
+            sizes=np.array([size for size, mtime in folded.values()], dtype=np.int64),
+            mtimes=np.array([mtime for size, mtime in folded.values()]),
+            **{column: aggregates[column].values for column in AGGREGATE_COLUMNS},
         )
+    replace(tmp_fname, fname)
 
-        for ix in fet_file.loc[great_snps].index:
-            chr = ix.split(":")[0]
-            all_stalk_freqs[chr].append(fet_file.loc[ix, "stalk_ratio"])
-            all_spore_freqs[chr].append(fet_file.loc[ix, "spore_ratio"])
 
+def sample_aggregates(task):
+    "One scores file's contribution to the running per-SNP sums"
+    fname, seed = task
+    fet, maxrank, rand_ps = read_shard((fname, seed, None))
+    good_snps = fet["rank"].values >= 0
+    semi_ps = np.where(good_snps, fet["rank"].values / maxrank, np.nan)
     return (
-        pvals_to_combine_fwd,
-        pvals_to_combine_rev,
-        pvals_to_combine_rand,
-        all_stalk_freqs,
-        all_spore_freqs,
-        pd.Series(stalk_ref_depth),
-        pd.Series(spore_ref_depth),
-        pd.Series(stalk_alt_depth),
-        pd.Series(spore_alt_depth),
-        any_good_snps,
-        fet_data,
+        pd.DataFrame(
+            {
+                "spore_stat": -2 * np.log(semi_ps),
+                "stalk_stat": -2 * np.log(1 - semi_ps + 1 / maxrank),
+                "random_stat": -2 * np.log(rand_ps),
+                "num_snps": good_snps.astype(int),
+                "stalk_ref_depth": fet.stalk_ref,
+                "spore_ref_depth": fet.spore_ref,
+                "stalk_alt_depth": fet.stalk_alt,
+                "spore_alt_depth": fet.spore_alt,
+            },
+            index=fet.index,
+        )
+        .fillna(0)
+        .sort_index()
     )
 
 
-def combine_all_pvals(table, indices):
-    out = pd.Series(index=table.keys(), data=nan, dtype=float)
+def combine_aggregates(aggregates):
+    """Fisher's method on the running sums of -2 log p
 
-    for ix in tqdm(indices):
-        out[ix] = combine_pvalues(table[ix], "fisher")[1]
+    Output: the combined spore, stalk, and random p-values for every SNP that
+    has at least one good sample.
+    """
+    tested = aggregates.loc[aggregates.num_snps > 0]
+    return [
+        pd.Series(
+            index=tested.index,
+            data=chi2.sf(tested[direction + "_stat"], 2 * tested.num_snps),
+        )
+        for direction in ["spore", "stalk", "random"]
+    ]
 
-    return out
+
+def write_combined_pvals(
+    output_prefix, combined_pvals_fwd, combined_pvals_rev, combined_pvals_rand
+):
+    "Sort and save the combined p-values, along with the best of stalk and spore"
+    combined_pvals_fwd.sort_values(inplace=True)
+    combined_pvals_rev.sort_values(inplace=True)
+    combined_pvals_nondir = (
+        pd.DataFrame({"stalk": combined_pvals_rev, "spore": combined_pvals_fwd})
+        .T.min()
+        .sort_index()
+    )
+    combined_pvals_rand.sort_values(inplace=True)
+
+    combined_pvals_fwd.to_csv(output_prefix + ".Spore.tsv", sep="\t", header=False)
+    combined_pvals_rev.to_csv(output_prefix + ".Stalk.tsv", sep="\t", header=False)
+    combined_pvals_rand.to_csv(output_prefix + ".Random.tsv", sep="\t", header=False)
+    combined_pvals_nondir.to_csv(output_prefix + ".Best.tsv", sep="\t", header=False)
+
+
+def write_all_table(
+    output_prefix,
+    combined_pvals_fwd,
+    combined_pvals_rev,
+    combined_pvals_rand,
+    stalk_ref_depth,
+    spore_ref_depth,
+    stalk_alt_depth,
+    spore_alt_depth,
+    num_snps,
+):
+    "Save the combined p-values, summed depths, and number of good samples"
+    out_table = pd.DataFrame(
+        {
+            "spore": combined_pvals_fwd,
+            "stalk": combined_pvals_rev,
+            "random": combined_pvals_rand,
+            "stalk_ref_depth": stalk_ref_depth[combined_pvals_fwd.index],
+            "spore_ref_depth": spore_ref_depth[combined_pvals_fwd.index],
+            "stalk_alt_depth": stalk_alt_depth[combined_pvals_fwd.index],
+            "spore_alt_depth": spore_alt_depth[combined_pvals_fwd.index],
+            "num_snps": num_snps,
+        }
+    )
+
+    out_table.sort_values(by="num_snps", inplace=True)
+    # Leave the index column's header blank, as it always has been
+    out_table.to_csv(output_prefix + ".all.tsv", sep="\t", header=True, index_label="")
+
+
+def combine_incrementally(args):
+    """Fold any new scores files into the running sums, and re-emit the tables
+
+    Only the scores files that aren't already in the sums get read, so adding a
+    sample takes the same time however many came before it. If any file that
+    was already summed in has changed or gone missing, the sums are rebuilt
+    from scratch. The new files are read on a pool of threads, and their random
+    sets are seeded the same as in load_data.
+    """
+    aggregates, folded = load_aggregates(args.aggregates)
+    fingerprints = {fname: file_fingerprint(fname) for fname in args.scores}
+    if any(fingerprints.get(fname) != fprint for fname, fprint in folded.items()):
+        print("Scores files have changed since the last run, starting over")
+        aggregates = pd.DataFrame(columns=AGGREGATE_COLUMNS, dtype=float)
+        folded = {}
+
+    new_scores = [
+        (fname, [args.seed, i])
+        for i, fname in enumerate(args.scores)
+        if fname not in folded
+    ]
+    print("Adding {} new samples to {}".format(len(new_scores), len(folded)))
+    with ThreadPool(args.threads) as pool:
+        for (fname, seed), sample in zip(
+            new_scores,
+            tqdm(pool.imap(sample_aggregates, new_scores), total=len(new_scores)),
+        ):
+            aggregates = aggregates.add(sample, fill_value=0)
+            folded[fname] = fingerprints[fname]
+    aggregates = aggregates.astype(AGGREGATE_COUNTS)
+    aggregates.index.name = "snp_id"
+    save_aggregates(args.aggregates, aggregates, folded)
+
+    combined_pvals = combine_aggregates(aggregates)
+    write_combined_pvals(args.output_prefix, *combined_pvals)
+    write_all_table(
+        args.output_prefix,
+        *combined_pvals,
+        aggregates.stalk_ref_depth,
+        aggregates.spore_ref_depth,
+        aggregates.stalk_alt_depth,
+        aggregates.spore_alt_depth,
+        aggregates.num_snps,
+    )
 
 
 startswith = lambda y: lambda x: x.startswith(y)
@@ -238,6 +763,32 @@ if __name__ == "__main__":
         if path.isdir(args.output_prefix)
         else args.output_prefix
     )
+    if args.fullrep is None:
+        args.fullrep = path.join(path.dirname(args.output_prefix), "fullrep_snps.tsv")
+
+    if args.incremental:
+        combine_incrementally(args)
+        exit()
+
+    cache_params = dict(names=args.scores, seed=args.seed, regions=args.regions)
+    parse_key = None
+    cached = None
+    if args.cache_dir is not None:
+        parse_key = cache_key("combined", args.scores, **cache_params)
+        cached = load_entry(args.cache_dir, parse_key)
+
+    if cached is None:
+        parsed = load_data(
+            args.scores, threads=args.threads, regions=args.regions, seed=args.seed
+        )
+        any_good_snps = parsed[9]
+        good_snps = any_good_snps.index[any_good_snps > 0]
+        combined_pvals = [combine_all_pvals(pvals, good_snps) for pvals in parsed[:3]]
+        if args.cache_dir is not None:
+            save_entry(args.cache_dir, parse_key, pack_parsed(parsed, combined_pvals))
+    else:
+        print("Loading parsed scores and combined p-values from the cache")
+        parsed, combined_pvals = unpack_parsed(cached)
 
     (
         pvals_to_combine_fwd,
@@ -251,80 +802,95 @@ if __name__ == "__main__":
         spore_alt_depth,
         any_good_snps,
         fet_data,
-    ) = load_data(args.scores)
-
-    pkl.dump(fet_data, open(args.output_prefix + ".fet_data.pkl", "wb"))
+    ) = parsed
+    combined_pvals_fwd, combined_pvals_rev, combined_pvals_rand = combined_pvals
+    all_good_snps = any_good_snps.index[any_good_snps == len(args.scores)]
 
     if not args.skip_fisher:
-        good_snps = any_good_snps.index[any_good_snps > 0]
-        with Pool(3) as pool:
-            combined_pvals_fwd = pool.apply_async(
-                combine_all_pvals, (pvals_to_combine_fwd, good_snps)
-            )
-            combined_pvals_rev = pool.apply_async(
-                combine_all_pvals, (pvals_to_combine_rev, good_snps)
+        write_fet_store(args.output_prefix + ".fet_data", fet_data)
+
+        if args.aggregates is not None:
+            aggregates = pd.DataFrame(
+                {
+                    "spore_stat": -2 * np.log(pvals_to_combine_fwd).sum(axis=1),
+                    "stalk_stat": -2 * np.log(pvals_to_combine_rev).sum(axis=1),
+                    "random_stat": -2 * np.log(pvals_to_combine_rand).sum(axis=1),
+                    "num_snps": any_good_snps,
+                    "stalk_ref_depth": stalk_ref_depth,
+                    "spore_ref_depth": spore_ref_depth,
+                    "stalk_alt_depth": stalk_alt_depth,
+                    "spore_alt_depth": spore_alt_depth,
+                }
+            ).fillna(0)
+            save_aggregates(
+                args.aggregates,
+                aggregates,
+                {fname: file_fingerprint(fname) for fname in args.scores},
             )
-            combined_pvals_rand = pool.apply_async(
-                combine_all_pvals, (pvals_to_combine_rand, good_snps)
-            )
-
-            combined_pvals_fwd = combined_pvals_fwd.get()
-            combined_pvals_rev = combined_pvals_rev.get()
-            combined_pvals_rand = combined_pvals_rand.get()
 
-        combined_pvals_fwd.sort_values(inplace=True)
-        combined_pvals_rev.sort_values(inplace=True)
-        combined_pvals_nondir = (
-            pd.DataFrame({"stalk": combined_pvals_rev, "spore": combined_pvals_fwd})
-            .T.min()
-            .sort_index()
+        write_combined_pvals(
+            args.output_prefix,
+            combined_pvals_fwd,
+            combined_pvals_rev,
+            combined_pvals_rand,
         )
-        combined_pvals_rand.sort_values(inplace=True)
 
-        combined_pvals_fwd.to_csv(
-            args.output_prefix + ".Spore.tsv", sep="\t", header=False
-        )
-        combined_pvals_rev.to_csv(
-            args.output_prefix + ".Stalk.tsv", sep="\t", header=False
-        )
-        combined_pvals_rand.to_csv(
-            args.output_prefix + ".Random.tsv", sep="\t", header=False
-        )
-        combined_pvals_nondir.to_csv(
-            args.output_prefix + ".Best.tsv", sep="\t", header=False
-        )
+        if args.permutations:
+            print("Running {} permutations".format(args.permutations))
+            permutation_key = None
+            if args.cache_dir is not None:
+                permutation_key = cache_key(
+                    "permutations",
+                    args.scores,
+                    permutations=args.permutations,
+                    fdr=args.fdr,
+                    # Results from before sample_shuffles used permutation()
+                    # were shuffled differently, so they don't match any more
+                    shuffle="permutation",
+                    **cache_params,
+                )
+            permuted_pvals, pval_cutoff = cached_permutation_pvals(
+                args.cache_dir,
+                permutation_key,
+                pvals_to_combine_fwd,
+                pvals_to_combine_rev,
+                combined_pvals_fwd,
+                combined_pvals_rev,
+                args.permutations,
+                seed=args.seed,
+                fdr=args.fdr,
+                threads=args.threads,
+                memory_budget=int(args.memory_budget * 2**30),
+            )
+            permuted_pvals.to_csv(args.output_prefix + ".permutations.tsv", sep="\t")
+            with open(args.output_prefix + ".pval_cutoff", "w") as out:
+                print(float(pval_cutoff), file=out)
+            print(
+                "p < {} for FDR {}: {} Spore and {} Stalk SNPs".format(
+                    pval_cutoff,
+                    args.fdr,
+                    (combined_pvals_fwd < pval_cutoff).sum(),
+                    (combined_pvals_rev < pval_cutoff).sum(),
+                )
+            )
 
-    out_table = pd.DataFrame(
-        {
-            "spore": combined_pvals_fwd,
-            "stalk": combined_pvals_rev,
-            "random": combined_pvals_rand,
-            "stalk_ref_depth": stalk_ref_depth[combined_pvals_fwd.index],
-            "spore_ref_depth": spore_ref_depth[combined_pvals_fwd.index],
-            "stalk_alt_depth": stalk_alt_depth[combined_pvals_fwd.index],
-            "spore_alt_depth": spore_alt_depth[combined_pvals_fwd.index],
-            "num_snps": any_good_snps,
-        }
-    )
+        write_all_table(
+            args.output_prefix,
+            combined_pvals_fwd,
+            combined_pvals_rev,
+            combined_pvals_rand,
+            stalk_ref_depth,
+            spore_ref_depth,
+            stalk_alt_depth,
+            spore_alt_depth,
+            any_good_snps,
+        )
 
-    out_table.sort_values(by="num_snps", inplace=True)
-    out_table.to_csv(args.output_prefix + ".all.tsv", sep="\t", header=True)
+        fullrep_table(fet_data, all_good_snps).to_csv(args.fullrep, sep="\t")
 
-    all_good_snps = any_good_snps.index[any_good_snps == len(args.scores)]
-    good_snps_stalk = pd.DataFrame(
-        index=all_good_snps, columns=fet_data.keys(), data=np.nan
-    )
-    good_snps_spore = pd.DataFrame(
-        index=all_good_snps, columns=fet_data.keys(), data=np.nan
-    )
-    for fname, fdata in fet_data.items():
-        for snp in all_good_snps:
-            good_snps_stalk.loc[snp, fname] = fdata.loc[snp, "stalk_ratio"]
-            good_snps_spore.loc[snp, fname] = fdata.loc[snp, "spore_ratio"]
-    good_snps = good_snps_spore.join(
-        good_snps_stalk, lsuffix="_spore", rsuffix="_stalk"
-    )
-    good_snps.to_csv("analysis/results/fullrep_snps.tsv", sep="\t")
+    if args.regions:
+        # Shards get merged with MergeCombinedPvals.py, and plotted after that
+        exit()
 
     print(
         "{} SNPs with any good samples\n{} SNPs with all good samples".format(
@@ -374,10 +940,10 @@ if __name__ == "__main__":
         ("random", combined_pvals_rand),
     ):
         plot_top_snps(
-            i_dataset.sort_values(),
+            i_dataset,
             i_name,
             any_good_snps,
-            fet_data,
+            dict(fet_data, snps=np.array(fet_data["snps"], dtype=bytes)),
             num_snps_to_plot=args.num_subplots,
             outdir=path.dirname(args.output_prefix) + "/",
         )
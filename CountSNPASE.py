@@ -3,13 +3,29 @@
 Output a tab-separated table with counts for reference, alternate, and
 non-ref/alt read counts at each SNP location in a provided bedfile.
 
+Given several BAM files at once, the counts for all of them are written to a
+single SNP x library x [REF, ALT, NON_REFALT] matrix in a .npz file instead, so
+the SNPs only have to be parsed once.
+
 Positions in the output are 1-based coordinates.
 """
 
 import pysam
 import argparse
+import numpy as np
+from os import path, makedirs, replace, getpid
+from sys import stderr
 from tqdm import tqdm
-from collections import defaultdict
+from collections import defaultdict, namedtuple
+from multiprocessing import Pool
+from ParseCache import file_digest
+
+ChromSnps = namedtuple("ChromSnps", ["pos", "refalt"])
+
+# CIGAR operations, as numbered by pysam
+MATCH_OPS = {0, 7, 8}  # M, =, X
+QUERY_OPS = {1, 4}  # I, S
+REFERENCE_OPS = {2, 3}  # D, N
 
 
 def pipesplit(col):
@@ -21,55 +37,334 @@ def parse_args():
 
     parser = argparse.ArgumentParser()
     parser.add_argument("snps", help="SNP BED file")
-    parser.add_argument("reads", help="Mapped reads file BAM or (untested) SAM")
-    parser.add_argument("output")
-    return parser.parse_args()
+    parser.add_argument(
+        "reads", nargs="+", help="Mapped reads file(s) BAM or (untested) SAM"
+    )
+    parser.add_argument(
+        "output",
+        help="Output count table. If this ends in .npz, write a count matrix of"
+        " all the libraries instead, which is required for more than one BAM.",
+    )
+    parser.add_argument(
+        "--fetch-windows",
+        default=False,
+        action="store_true",
+        help="Use the BAM index to fetch only reads overlapping the SNPs, rather"
+        " than scanning the whole file. Requires a .bai index.",
+    )
+    parser.add_argument(
+        "--window-gap",
+        type=int,
+        default=1000,
+        help="SNPs closer than this (in bp) are fetched together in one window",
+    )
+    parser.add_argument(
+        "--threads",
+        "-t",
+        type=int,
+        default=1,
+        help="Number of processes to count with. More than one implies"
+        " --fetch-windows, with the genome split into chunks across processes",
+    )
+    parser.add_argument(
+        "--chrom-sizes",
+        default=None,
+        help="chrom.sizes file used to split the genome into chunks"
+        " (default: chromosome lengths from the BAM header). Chromosomes with"
+        " SNPs that it doesn't list get their length from the BAM header",
+    )
+    parser.add_argument(
+        "--tsv-output",
+        action="append",
+        dest="tsv_outputs",
+        default=[],
+        help="Also write a count table for a library here. Give it once per BAM"
+        " file, in the same order",
+    )
+    parser.add_argument(
+        "--cache-dir",
+        default=None,
+        help="Directory of per-BAM count caches. On a rerun, only SNPs that"
+        " are not already in a BAM's cache get counted.",
+    )
+    args = parser.parse_args()
+    if len(args.reads) > 1 and not args.output.endswith(".npz"):
+        parser.error("Counting more than one BAM file needs a .npz output")
+    if args.tsv_outputs and len(args.tsv_outputs) != len(args.reads):
+        parser.error("Need exactly one --tsv-output per BAM file")
+    return args
 
 
 def parse_bed(fname):
-    """Parse bedfile into a by-chromosome ref/alt dictionary.
+    """Parse bedfile into a by-chromosome array-backed SNP index.
 
-    Output: Dictionary of dictionaries. Outer dictionary keyed by chromosome
-    name, inner dictionary keyed by 0-based SNP coordinate.  Each element of the
-    inner dictionary is a list of [REFERENCE_BASE, ALTERNATE_BASE]
-        """
-    outdict = defaultdict(dict)
+    Output: Dictionary keyed by chromosome name. Each element is a ChromSnps
+    tuple holding a sorted array of the 0-based SNP coordinates, and an (N, 2)
+    array with the ASCII codes of [REFERENCE_BASE, ALTERNATE_BASE] for each
+    SNP. If a position is listed more than once, the last entry wins. Lines
+    whose REF|ALT isn't two single bases (like indels) are skipped, with a
+    message.
+    """
+    positions = defaultdict(list)
+    refalts = defaultdict(list)
+    skipped = []
     for line in open(fname):
         chr, pos0, pos1, refalt = line.split()
-        pos0 = int(pos0)
-        chrdict = outdict[chr]
-        chrdict[pos0] = refalt.split("|")
+        if len(refalt) != 3 or refalt[1] != "|":
+            skipped.append(refalt)
+            continue
+        positions[chr].append(int(pos0))
+        refalts[chr].append(refalt)
+    if skipped:
+        print(
+            "Skipped {} lines of {} that aren't single-base REF|ALT SNPs"
+            " (like {})".format(len(skipped), fname, skipped[0]),
+            file=stderr,
+        )
+
+    outdict = {}
+    for chr in positions:
+        pos = np.array(positions[chr], dtype=np.int32)
+        codes = np.frombuffer("".join(refalts[chr]).encode(), dtype=np.uint8)
+        codes = codes.reshape(-1, 3)[:, ::2]
+        order = np.argsort(pos, kind="mergesort")
+        pos = pos[order]
+        codes = codes[order]
+        is_last = np.append(pos[1:] != pos[:-1], True)
+        outdict[chr] = ChromSnps(pos[is_last], codes[is_last])
     return outdict
 
 
-if __name__ == "__main__":
-    args = parse_args()
-    snps = parse_bed(args.snps)
+def empty_counts(snps, num_libraries=1):
+    "Preallocate a library x [REF, ALT, NON_REFALT] count array for every SNP"
+    return {
+        chrom: np.zeros((len(chrsnps.pos), num_libraries, 3), dtype=np.int32)
+        for chrom, chrsnps in snps.items()
+    }
+
+
+def library_counts(counts, library):
+    "View of the [REF, ALT, NON_REFALT] counts for a single library"
+    return {chrom: chrcounts[:, library] for chrom, chrcounts in counts.items()}
+
+
+def snp_windows(positions, max_gap):
+    """Merge the SNPs on one chromosome into windows for fetching reads
+
+    SNPs that are within max_gap bp of each other end up in the same window, so
+    we do one index lookup per cluster of SNPs, rather than one per SNP.
+    Windows are half-open, 0-based [start, stop) intervals.
+    """
+    if len(positions) == 0:
+        return []
+    breaks = np.flatnonzero(np.diff(positions) > max_gap) + 1
+    starts = positions[np.r_[0, breaks]]
+    stops = positions[np.r_[breaks - 1, len(positions) - 1]] + 1
+    return list(zip(starts.tolist(), stops.tolist()))
+
+
+def aligned_blocks(read):
+    """Walk the CIGAR string to find the gapless aligned blocks of a read
+
+    Returns lists of the reference start, reference stop, and query start of
+    each block. This is the same as read.get_blocks(), but also keeps track of
+    where each block is in the read sequence.
+    """
+    rstarts = []
+    rstops = []
+    qstarts = []
+    rpos = read.reference_start
+    qpos = 0
+    for op, length in read.cigartuples:
+        if op in MATCH_OPS:
+            rstarts.append(rpos)
+            rstops.append(rpos + length)
+            qstarts.append(qpos)
+            rpos += length
+            qpos += length
+        elif op in QUERY_OPS:
+            qpos += length
+        elif op in REFERENCE_OPS:
+            rpos += length
+    return rstarts, rstops, qstarts
+
+
+def count_read(read, chrsnps, counts):
+    """Add the bases from a single read to the counts array
 
-    out_table = {(chr, pos + 1): [0, 0, 0] for chr in snps for pos in snps[chr]}
+    The SNPs in each aligned block are found by binary search, so only the bases
+    that actually hit a SNP get looked at.
+    """
+    rstarts, rstops, qstarts = aligned_blocks(read)
+    if not rstarts or read.query_sequence is None:
+        return
+    lows = chrsnps.pos.searchsorted(rstarts).tolist()
+    highs = chrsnps.pos.searchsorted(rstops).tolist()
+    seq = None
+    for low, high, rstart, qstart in zip(lows, highs, rstarts, qstarts):
+        for i in range(low, high):
+            if seq is None:
+                seq = read.query_sequence.encode()
+            # Clearing the 0x20 bit upper-cases an ASCII letter
+            base = seq[qstart + int(chrsnps.pos[i]) - rstart] & 0xDF
+            ref, alt = chrsnps.refalt[i]
+            if base == ref:
+                counts[i, 0] += 1
+            elif base == alt:
+                counts[i, 1] += 1
+            else:
+                counts[i, 2] += 1
 
-    reads = pysam.AlignmentFile(args.reads)
+
+def count_all_reads(reads, snps, counts):
+    "Count every read in the file, without using the index"
     chrnames = reads.references
     for read in tqdm(reads, total=reads.mapped):
+        if read.is_unmapped:
+            continue
         chrom = chrnames[read.reference_id]
         if chrom not in snps:
             continue
-        chrsnps = snps[chrom]
-        seq = read.seq
-
-        for rpos, pos in read.get_aligned_pairs(matches_only=True):
-            base = read.seq[rpos].upper()
-            ptuple = chrom, pos + 1
-            if pos in chrsnps:
-                ref, alt = chrsnps[pos]
-                if base == ref:
-                    out_table[ptuple][0] += 1
-                elif base == alt:
-                    out_table[ptuple][1] += 1
-                else:
-                    out_table[ptuple][2] += 1
-
-    with open(args.output, "w") as outfh:
+        count_read(read, snps[chrom], counts[chrom])
+
+
+def count_region(reads, chrom, chrsnps, counts, max_gap=1000):
+    """Count only the reads that overlap the given SNPs, using the index
+
+    A read that overlaps two adjacent windows is only counted in the first of
+    them, so every read is decoded at most once.
+    """
+    prev_stop = 0
+    for start, stop in snp_windows(chrsnps.pos, max_gap):
+        for read in reads.fetch(chrom, start, stop):
+            if read.is_unmapped or read.reference_start < prev_stop:
+                continue
+            count_read(read, chrsnps, counts)
+        prev_stop = stop
+
+
+def count_fetched_reads(reads, snps, counts, max_gap=1000):
+    "Count the reads overlapping SNPs on each chromosome, using the index"
+    for chrom in tqdm(sorted(set(snps).intersection(reads.references))):
+        count_region(reads, chrom, snps[chrom], counts[chrom], max_gap)
+
+
+def parse_chrom_sizes(fname):
+    "Parse a chrom.sizes style file into a list of (chromosome, length) pairs"
+    chrom_sizes = []
+    for line in open(fname):
+        chrom, size = line.split()[:2]
+        chrom_sizes.append((chrom, int(size)))
+    return chrom_sizes
+
+
+def genome_chunks(chrom_sizes, num_chunks):
+    """Split the genome into about num_chunks pieces of similar size
+
+    Each chromosome is cut into equal pieces no bigger than the target size, so
+    small chromosomes get a chunk to themselves and large ones are split.
+    Chunks are half-open, 0-based (chrom, start, stop) intervals.
+    """
+    target = max(1, -(-sum(size for _, size in chrom_sizes) // num_chunks))
+    chunks = []
+    for chrom, size in chrom_sizes:
+        num_pieces = max(1, -(-size // target))
+        bounds = [size * i // num_pieces for i in range(num_pieces + 1)]
+        chunks.extend((chrom, start, stop) for start, stop in zip(bounds, bounds[1:]))
+    return chunks
+
+
+_worker_state = {}
+
+
+def init_worker(library_snps, max_gap):
+    "Set up the SNPs for a worker process, which opens its own BAM handles"
+    _worker_state["reads"] = {}
+    _worker_state["snps"] = library_snps
+    _worker_state["max_gap"] = max_gap
+
+
+def count_chunk(task):
+    "Count the SNPs within a single genome chunk of one library, in a worker"
+    library, reads_fname, chrom, start, stop = task
+    if reads_fname not in _worker_state["reads"]:
+        _worker_state["reads"][reads_fname] = pysam.AlignmentFile(reads_fname)
+    chrsnps = _worker_state["snps"][library][chrom]
+    low, high = chrsnps.pos.searchsorted([start, stop])
+    chunk_snps = ChromSnps(chrsnps.pos[low:high], chrsnps.refalt[low:high])
+    chunk_counts = np.zeros((high - low, 3), dtype=np.int32)
+    count_region(
+        _worker_state["reads"][reads_fname],
+        chrom,
+        chunk_snps,
+        chunk_counts,
+        _worker_state["max_gap"],
+    )
+    return library, chrom, low, chunk_counts
+
+
+def snp_chrom_sizes(chrom_sizes, header_sizes, library_snps):
+    """The (chrom, size) pairs to split into chunks, covering every SNP
+
+    Chromosomes with SNPs that aren't in chrom_sizes are added from the BAM
+    header's sizes, and each size is stretched to reach its last SNP. A SNP
+    chromosome that's in neither is an error, rather than silently uncounted.
+    """
+    sizes = dict(chrom_sizes)
+    header_sizes = dict(header_sizes)
+    for snps in library_snps:
+        for chrom, chrsnps in snps.items():
+            if not len(chrsnps.pos):
+                continue
+            if chrom not in sizes:
+                if chrom not in header_sizes:
+                    raise ValueError(
+                        "SNPs on {}, which isn't in the chrom sizes or the BAM"
+                        " header".format(chrom)
+                    )
+                sizes[chrom] = header_sizes[chrom]
+            sizes[chrom] = max(sizes[chrom], int(chrsnps.pos[-1]) + 1)
+    return list(sizes.items())
+
+
+def count_parallel(
+    reads_fnames, library_snps, counts, threads, chrom_sizes=None, max_gap=1000
+):
+    """Count reads overlapping SNPs, split into genome chunks across processes
+
+    Each chunk only counts its own SNPs, so a read that spans a chunk boundary
+    is decoded by both chunks but each SNP is still counted exactly once. All of
+    the libraries share the same pool of workers, but each library gets its own
+    SNPs to count and its own count arrays.
+
+    Every chromosome with SNPs gets chunks: chrom_sizes comes first, and any
+    chromosome it doesn't list gets its length from the BAM header.
+    """
+    with pysam.AlignmentFile(reads_fnames[0]) as reads:
+        header_sizes = list(zip(reads.references, reads.lengths))
+    chrom_sizes = snp_chrom_sizes(
+        header_sizes if chrom_sizes is None else chrom_sizes,
+        header_sizes,
+        library_snps,
+    )
+    tasks = []
+    for library, reads_fname in enumerate(reads_fnames):
+        for chrom, start, stop in genome_chunks(chrom_sizes, 4 * threads):
+            if chrom not in library_snps[library]:
+                continue
+            low, high = library_snps[library][chrom].pos.searchsorted([start, stop])
+            if high > low:
+                tasks.append((library, reads_fname, chrom, start, stop))
+    with Pool(threads, init_worker, (library_snps, max_gap)) as pool:
+        for library, chrom, low, chunk_counts in tqdm(
+            pool.imap(count_chunk, tasks), total=len(tasks)
+        ):
+            counts[library][chrom][low : low + len(chunk_counts)] += chunk_counts
+
+
+def write_counts(fname, snps, counts):
+    "Write out the counts table, sorted by chromosome and position"
+    with open(fname, "w") as outfh:
         print(
             "CHROM",
             "POS",
@@ -81,12 +376,178 @@ if __name__ == "__main__":
             sep="\t",
             file=outfh,
         )
-        for (chrom, pos) in sorted(out_table):
-            print(
-                chrom,
-                pos,
-                *snps[chrom][pos - 1],
-                *out_table[(chrom, pos)],
-                sep="\t",
-                file=outfh
+        for chrom in sorted(snps):
+            chrsnps = snps[chrom]
+            for pos, (ref, alt), (n_ref, n_alt, n_other) in zip(
+                chrsnps.pos.tolist(),
+                chrsnps.refalt.tolist(),
+                counts[chrom].tolist(),
+            ):
+                print(
+                    chrom,
+                    pos + 1,
+                    chr(ref),
+                    chr(alt),
+                    n_ref,
+                    n_alt,
+                    n_other,
+                    sep="\t",
+                    file=outfh,
+                )
+
+
+def bam_fingerprint(fname):
+    """Fingerprint the contents of a BAM file, for caching its counts
+
+    This hashes the whole file, so a BAM that's rewritten in any way gets a new
+    cache. That means reading every BAM once per run, but that's still much
+    less work than counting it again, and going by sizes or modification times
+    instead could reuse stale counts.
+    """
+    return file_digest(fname)
+
+
+def load_cached_counts(cache_fname, snps, counts):
+    """Fill in the counts for any SNPs that are already in the cache
+
+    A cached SNP is only reused if its position, reference and alternate bases
+    all match. Returns a dictionary of the indices of the SNPs on each
+    chromosome that still need to be counted.
+    """
+    missing = {chrom: np.arange(len(chrsnps.pos)) for chrom, chrsnps in snps.items()}
+    if not path.exists(cache_fname):
+        return missing
+    with np.load(cache_fname) as npz:
+        cache = {name: npz[name] for name in npz.files}
+    for chrom_index, chrom in enumerate(cache["chroms"].tolist()):
+        if chrom not in snps:
+            continue
+        chrsnps = snps[chrom]
+        on_chrom = cache["chrom_index"] == chrom_index
+        cached_pos = cache["pos"][on_chrom] - 1
+        cached_refalt = cache["refalt"][on_chrom]
+        cached_counts = cache["counts"][on_chrom, 0]
+        ix = cached_pos.searchsorted(chrsnps.pos).clip(0, len(cached_pos) - 1)
+        in_cache = (cached_pos[ix] == chrsnps.pos) & np.all(
+            cached_refalt[ix] == chrsnps.refalt, axis=1
+        )
+        counts[chrom][in_cache] = cached_counts[ix[in_cache]]
+        missing[chrom] = np.flatnonzero(~in_cache)
+    return missing
+
+
+def write_count_matrix(fname, snps, counts, libraries):
+    """Write the counts for all libraries as a single .npz matrix
+
+    The matrix has one row per SNP, sorted by chromosome and position, so that
+    the rows line up with the rows of the per-library count tables.
+    """
+    chroms = sorted(snps)
+    np.savez(
+        fname,
+        chroms=np.array(chroms),
+        chrom_index=np.repeat(
+            np.arange(len(chroms), dtype=np.int16),
+            [len(snps[chrom].pos) for chrom in chroms],
+        ),
+        pos=np.concatenate([snps[chrom].pos + 1 for chrom in chroms]),
+        refalt=np.concatenate([snps[chrom].refalt for chrom in chroms]),
+        libraries=np.array(libraries),
+        counts=np.concatenate([counts[chrom] for chrom in chroms]),
+    )
+
+
+def load_count_matrix(fname):
+    """Load a count matrix written by write_count_matrix
+
+    Output: Dictionary with the CHROM, POS, REF_BASE, and ALT_BASE of each SNP,
+    the list of libraries, and the SNP x library x [REF, ALT, NON_REFALT] array
+    of counts.
+    """
+    data = np.load(fname)
+    refalt = data["refalt"].view("S1").astype(str)
+    return dict(
+        CHROM=data["chroms"][data["chrom_index"]],
+        POS=data["pos"],
+        REF_BASE=refalt[:, 0],
+        ALT_BASE=refalt[:, 1],
+        libraries=data["libraries"].tolist(),
+        counts=data["counts"],
+    )
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    snps = parse_bed(args.snps)
+
+    counts = empty_counts(snps, len(args.reads))
+
+    # Without a cache, every library counts every SNP straight into counts
+    library_snps = [snps for reads_fname in args.reads]
+    to_count = [library_counts(counts, i) for i in range(len(args.reads))]
+    missing = [None for reads_fname in args.reads]
+    cache_fnames = []
+    if args.cache_dir is not None:
+        makedirs(args.cache_dir, exist_ok=True)
+        for library, reads_fname in enumerate(tqdm(args.reads)):
+            cache_fname = path.join(
+                args.cache_dir, bam_fingerprint(reads_fname) + ".npz"
+            )
+            cache_fnames.append(cache_fname)
+            missing[library] = load_cached_counts(
+                cache_fname, snps, library_counts(counts, library)
             )
+            library_snps[library] = {
+                chrom: ChromSnps(snps[chrom].pos[ix], snps[chrom].refalt[ix])
+                for chrom, ix in missing[library].items()
+            }
+            to_count[library] = library_counts(empty_counts(library_snps[library]), 0)
+        print(
+            "Counting",
+            sum(len(ix) for lib_missing in missing for ix in lib_missing.values()),
+            "SNPs not in the caches",
+        )
+
+    if args.threads > 1:
+        chrom_sizes = None
+        if args.chrom_sizes is not None:
+            chrom_sizes = parse_chrom_sizes(args.chrom_sizes)
+        count_parallel(
+            args.reads,
+            library_snps,
+            to_count,
+            args.threads,
+            chrom_sizes=chrom_sizes,
+            max_gap=args.window_gap,
+        )
+    else:
+        for library, reads_fname in enumerate(args.reads):
+            reads = pysam.AlignmentFile(reads_fname)
+            if args.fetch_windows:
+                count_fetched_reads(
+                    reads, library_snps[library], to_count[library], args.window_gap
+                )
+            else:
+                count_all_reads(reads, library_snps[library], to_count[library])
+
+    for library, cache_fname in enumerate(cache_fnames):
+        for chrom, ix in missing[library].items():
+            counts[chrom][ix, library] = to_count[library][chrom]
+        # Write to a temporary file first, so an interrupted run can't leave a
+        # truncated cache behind, and the rules counting the same BAM at once
+        # don't write over each other's
+        tmp_fname = "{}.{}.tmp.npz".format(cache_fname, getpid())
+        write_count_matrix(
+            tmp_fname,
+            snps,
+            {chrom: chrcounts[:, [library]] for chrom, chrcounts in counts.items()},
+            [args.reads[library]],
+        )
+        replace(tmp_fname, cache_fname)
+
+    if args.output.endswith(".npz"):
+        write_count_matrix(args.output, snps, counts, args.reads)
+    else:
+        write_counts(args.output, snps, library_counts(counts, 0))
+    for library, tsv_fname in enumerate(args.tsv_outputs):
+        write_counts(tsv_fname, snps, library_counts(counts, library))
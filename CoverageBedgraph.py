@@ -0,0 +1,179 @@
+""" Coverage of a BAM as a bedgraph, any-coverage intervals and a bigWig
+
+This takes the place of bedtools genomecov -bga, grep, bedtools sort, bioawk,
+bedtools merge and bedGraphToBigWig, each of which made a full pass over the
+genome. Instead, the reads on each chromosome are read once (one chromosome per
+worker) into an array of the depth at every base, and all three outputs are
+made from the runs of equal depth in those arrays.
+"""
+
+import subprocess
+import numpy as np
+import pandas as pd
+import pysam
+from argparse import ArgumentParser
+from os import getpid, replace
+from PlotBamGCBias import read_spans
+from SharedPool import shared_pool, worker_state
+
+try:
+    import pyBigWig
+except ImportError:
+    pyBigWig = None
+
+
+def parse_args():
+    parser = ArgumentParser()
+    parser.add_argument("bam", help="Indexed BAM file")
+    parser.add_argument(
+        "--genome",
+        "-g",
+        required=True,
+        help="chrom.sizes file, for bedGraphToBigWig if pyBigWig isn't installed",
+    )
+    parser.add_argument("--cov", required=True, help="Where to put the bedgraph")
+    parser.add_argument(
+        "--anycov",
+        default=None,
+        help="Where to put the intervals with any coverage, merged across gaps"
+        " of up to --max-gap",
+    )
+    parser.add_argument("--bigwig", default=None, help="Where to put the bigWig")
+    parser.add_argument("--max-gap", default=5, type=int)
+    parser.add_argument(
+        "--exclude",
+        action="append",
+        default=None,
+        help="Leave out chromosomes whose names contain this (default: NC_0)",
+    )
+    parser.add_argument(
+        "--threads",
+        "-t",
+        default=1,
+        type=int,
+        help="Number of chromosomes to work on at once",
+    )
+    args = parser.parse_args()
+    if args.exclude is None:
+        args.exclude = ["NC_0"]
+    return args
+
+
+def depth_array(starts, ends, length):
+    "Depth at each base of a chromosome, from the sorted starts and ends of reads"
+    change = np.bincount(starts, minlength=length + 1)[: length + 1]
+    change -= np.bincount(np.minimum(ends, length), minlength=length + 1)
+    return np.cumsum(change[:length])
+
+
+def depth_runs(depth):
+    """Runs of equal depth, which cover the whole chromosome
+
+    Output: the start, stop and depth of each run.
+    """
+    if not len(depth):
+        return (np.zeros(0, dtype=np.int64),) * 3
+    bounds = np.flatnonzero(np.diff(depth)) + 1
+    starts = np.concatenate([[0], bounds])
+    stops = np.concatenate([bounds, [len(depth)]])
+    return starts, stops, depth[starts]
+
+
+def merge_intervals(starts, stops, max_gap=0):
+    "Merge sorted intervals no more than max_gap apart, like bedtools merge -d"
+    if not len(starts):
+        return starts, stops
+    new_interval = np.concatenate([[True], starts[1:] - stops[:-1] > max_gap])
+    last = np.concatenate([np.flatnonzero(new_interval)[1:] - 1, [len(stops) - 1]])
+    return starts[new_interval], stops[last]
+
+
+def chrom_coverage(chrom):
+    """Runs of equal depth on one chromosome of the BAM
+
+    Run in a pool from shared_pool, with the BAM's name and the chromosome sizes
+    (from its header) in worker_state.
+    """
+    with pysam.AlignmentFile(worker_state["bam"]) as reads:
+        starts, ends = read_spans(reads, chrom)
+    depth = depth_array(starts, ends, worker_state["chrom_sizes"][chrom])
+    return chrom, depth_runs(depth)
+
+
+def write_bed(fname, intervals):
+    "Write out (chrom, columns) pairs as a bed file, one chromosome at a time"
+    tmp_fname = "{}.{}.tmp".format(fname, getpid())
+    with open(tmp_fname, "w") as out:
+        for chrom, columns in intervals:
+            table = pd.DataFrame(dict(enumerate(columns, 1)))
+            table.insert(0, 0, chrom)
+            table.to_csv(out, sep="\t", header=False, index=False)
+    replace(tmp_fname, fname)
+
+
+def write_bigwig(fname, runs, bedgraph, genome, chrom_sizes):
+    """Save the coverage as a bigWig
+
+    With pyBigWig, it's written straight from the runs; otherwise, from the
+    bedgraph with bedGraphToBigWig.
+    """
+    tmp_fname = "{}.{}.tmp".format(fname, getpid())
+    if pyBigWig is None:
+        try:
+            subprocess.run(
+                ["bedGraphToBigWig", bedgraph, genome, tmp_fname], check=True
+            )
+        except FileNotFoundError:
+            raise RuntimeError(
+                "Writing a bigWig needs pyBigWig (pybigwig in envs/dicty.yaml) or"
+                " bedGraphToBigWig"
+            )
+    else:
+        bw = pyBigWig.open(tmp_fname, "w")
+        bw.addHeader([(chrom, chrom_sizes[chrom]) for chrom, _ in runs])
+        for chrom, (starts, stops, depths) in runs:
+            if len(starts):
+                bw.addEntries(
+                    [chrom] * len(starts),
+                    starts.tolist(),
+                    ends=stops.tolist(),
+                    values=depths.astype(float).tolist(),
+                )
+        bw.close()
+    replace(tmp_fname, fname)
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    with pysam.AlignmentFile(args.bam) as reads:
+        chrom_sizes = dict(zip(reads.references, reads.lengths))
+    chroms = [
+        chrom
+        for chrom in chrom_sizes
+        if not any(exclude in chrom for exclude in args.exclude)
+    ]
+
+    # Biggest chromosomes first, so no worker is left with a big one at the end
+    tasks = sorted(chroms, key=chrom_sizes.get, reverse=True)
+    with shared_pool(
+        min(args.threads, len(tasks)), {}, bam=args.bam, chrom_sizes=chrom_sizes
+    ) as pool:
+        runs = dict(pool.imap_unordered(chrom_coverage, tasks))
+    runs = sorted(runs.items())
+
+    write_bed(args.cov, runs)
+    if args.anycov is not None:
+        write_bed(
+            args.anycov,
+            [
+                (
+                    chrom,
+                    merge_intervals(
+                        starts[depths > 0], stops[depths > 0], args.max_gap
+                    ),
+                )
+                for chrom, (starts, stops, depths) in runs
+            ],
+        )
+    if args.bigwig is not None:
+        write_bigwig(args.bigwig, runs, args.cov, args.genome, chrom_sizes)
@@ -0,0 +1,131 @@
+""" Put together the shards from CombinePvals.py --region/--chrom
+
+Each shard has its own combined p-values, .all table, .fet_data store and
+fullrep_snps.tsv; this writes them back out under one output prefix, the same
+as a whole-genome run of CombinePvals.py would have.
+"""
+
+from os import path, makedirs
+from argparse import ArgumentParser
+import numpy as np
+import pandas as pd
+from numpy.lib.format import open_memmap
+from CombinePvals import write_combined_pvals, write_all_table
+from PlotCombinedPvals import load_fet_store, FET_COLUMNS
+
+
+def parse_args():
+    parser = ArgumentParser()
+    parser.add_argument("--output-prefix", "-o", required=True)
+    parser.add_argument(
+        "--fullrep",
+        default=None,
+        help="Where to save the merged fullrep_snps.tsv (default: next to the"
+        " output prefix). Each shard's is read from next to its prefix.",
+    )
+    parser.add_argument(
+        "shards", nargs="+", help="The --output-prefix of each CombinePvals.py shard"
+    )
+    args = parser.parse_args()
+    if args.fullrep is None:
+        args.fullrep = path.join(path.dirname(args.output_prefix), "fullrep_snps.tsv")
+    return args
+
+
+def read_table(fname, **kwargs):
+    "Read a shard's table, getting back exactly the floats that were written"
+    return pd.read_csv(
+        fname, sep="\t", index_col=0, float_precision="round_trip", **kwargs
+    )
+
+
+def read_combined_pvals(fname):
+    "Read a headerless SNP, p-value table as a Series"
+    try:
+        return read_table(fname, header=None)[1].rename(None)
+    except pd.errors.EmptyDataError:
+        return pd.Series([], dtype=float)
+
+
+def merge_pvals(shards, kind):
+    return pd.concat(
+        [read_combined_pvals("{}.{}.tsv".format(shard, kind)) for shard in shards]
+    )
+
+
+def merge_fet_stores(dirname, shards):
+    """Stack the shards' fet stores into one
+
+    The shards can't overlap, so once they're ordered by their first SNP, the
+    stacked SNP ids are still sorted.
+    """
+    stores = [load_fet_store(shard + ".fet_data") for shard in shards]
+    stores = sorted(
+        (store for store in stores if len(store["snps"])),
+        key=lambda store: store["snps"][0],
+    )
+    if not stores:
+        raise ValueError("All of the shards are empty")
+    samples = stores[0]["samples"]
+    for store in stores[1:]:
+        if store["samples"] != samples:
+            raise ValueError("Shards were run on different samples")
+
+    snps = np.concatenate([store["snps"] for store in stores])
+    if np.any(snps[1:] <= snps[:-1]):
+        raise ValueError("Shards overlap")
+
+    makedirs(dirname, exist_ok=True)
+    np.save(path.join(dirname, "snps.npy"), snps)
+    np.save(path.join(dirname, "samples.npy"), np.array(samples, dtype=str))
+    for column in FET_COLUMNS:
+        first = stores[0][column]
+        out = open_memmap(
+            path.join(dirname, column + ".npy"),
+            mode="w+",
+            dtype=first.dtype,
+            shape=(len(snps), len(samples)),
+        )
+        start = 0
+        for store in stores:
+            out[start : start + len(store["snps"])] = store[column]
+            start += len(store["snps"])
+        out.flush()
+        del out
+
+
+if __name__ == "__main__":
+    args = parse_args()
+
+    pvals_fwd = merge_pvals(args.shards, "Spore")
+    pvals_rev = merge_pvals(args.shards, "Stalk")
+    pvals_rand = merge_pvals(args.shards, "Random")
+    write_combined_pvals(args.output_prefix, pvals_fwd, pvals_rev, pvals_rand)
+
+    all_table = pd.concat([read_table(shard + ".all.tsv") for shard in args.shards])
+    write_all_table(
+        args.output_prefix,
+        all_table.spore.dropna(),
+        all_table.stalk.dropna(),
+        all_table.random.dropna(),
+        *(
+            all_table[depth].dropna().astype(np.int64)
+            for depth in [
+                "stalk_ref_depth",
+                "spore_ref_depth",
+                "stalk_alt_depth",
+                "spore_alt_depth",
+            ]
+        ),
+        all_table.num_snps,
+    )
+
+    merge_fet_stores(args.output_prefix + ".fet_data", args.shards)
+
+    fullrep = pd.concat(
+        [
+            read_table(path.join(path.dirname(shard), "fullrep_snps.tsv"))
+            for shard in args.shards
+        ]
+    )
+    fullrep.sort_index().to_csv(args.fullrep, sep="\t")
@@ -0,0 +1,136 @@
+""" Content-addressed cache of parsed inputs and the results made from them
+
+Each entry is a directory of .npy files, named by a hash of the contents of the
+files it was made from and of the parameters that went into it, so an entry can
+never go stale: changing an input or a parameter just makes a new entry.
+Loading an entry memory-maps its arrays, so it's fast no matter how big it is.
+
+Since nothing else ever removes old entries, saving one also prunes the
+cache back down to max_bytes, dropping the least recently used entries first.
+Only directories that save_entry made are ever pruned, so anything else that
+happens to be in the cache directory is left alone.
+"""
+
+import hashlib
+import json
+import re
+from os import path, makedirs, replace, getpid, listdir, utime, walk
+from shutil import rmtree
+import numpy as np
+
+# Bump this when what goes into an entry changes
+CACHE_VERSION = 1
+
+# How big a cache directory can get before its oldest entries are removed
+MAX_CACHE_BYTES = 20 * 2**30
+
+# Every entry is named like this (see cache_key), and has this (empty) file in
+# it, written by save_entry
+ENTRY_NAME = re.compile(r"^\w+-[0-9a-f]{40}$")
+ENTRY_MARKER = ".parse_cache_entry"
+
+
+def file_digest(fname, block_size=2**20):
+    "SHA-1 of a file's contents"
+    digest = hashlib.sha1()
+    with open(fname, "rb") as fh:
+        for block in iter(lambda: fh.read(block_size), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def cache_key(name, filenames, **params):
+    "Key for an entry made from the given files (in order) and parameters"
+    digest = hashlib.sha1()
+    digest.update(
+        json.dumps(
+            [
+                CACHE_VERSION,
+                name,
+                [file_digest(fname) for fname in filenames],
+                sorted(params.items()),
+            ],
+            default=str,
+        ).encode()
+    )
+    return "{}-{}".format(name, digest.hexdigest())
+
+
+def load_entry(cache_dir, key):
+    "Memory-map the arrays in a cache entry, or None if it hasn't been made yet"
+    if cache_dir is None:
+        return None
+    dirname = path.join(cache_dir, key)
+    try:
+        # Mark it as used, so it's the last to get pruned
+        utime(dirname)
+        return {
+            fname[: -len(".npy")]: np.load(path.join(dirname, fname), mmap_mode="r")
+            for fname in listdir(dirname)
+            if fname.endswith(".npy")
+        }
+    except OSError:
+        # Never made, or pruned by another job while we were loading it
+        return None
+
+
+def entry_bytes(dirname):
+    "Total size of the files in a cache entry"
+    return sum(
+        path.getsize(path.join(root, fname))
+        for root, _, fnames in walk(dirname)
+        for fname in fnames
+    )
+
+
+def is_entry(cache_dir, key):
+    "Whether this is a cache entry that save_entry made (and so can be pruned)"
+    return bool(ENTRY_NAME.match(key)) and path.isfile(
+        path.join(cache_dir, key, ENTRY_MARKER)
+    )
+
+
+def prune_cache(cache_dir, max_bytes=MAX_CACHE_BYTES, keep=()):
+    """Remove the least recently used entries until the cache fits in max_bytes
+
+    Entries named in keep, and any that are still being written, stay put, as
+    does everything in cache_dir that isn't an entry.
+    """
+    entries = []
+    for key in listdir(cache_dir):
+        dirname = path.join(cache_dir, key)
+        if not is_entry(cache_dir, key):
+            continue
+        try:
+            entries.append((path.getmtime(dirname), entry_bytes(dirname), key))
+        except OSError:
+            continue
+    total = sum(size for _, size, _ in entries)
+    for _, size, key in sorted(entries):
+        if total <= max_bytes:
+            break
+        if key in keep:
+            continue
+        rmtree(path.join(cache_dir, key), ignore_errors=True)
+        total -= size
+
+
+def save_entry(cache_dir, key, arrays, max_bytes=MAX_CACHE_BYTES):
+    """Save a dictionary of arrays as a cache entry
+
+    The entry is written to a temporary directory and then moved into place, so
+    a half-written entry is never loaded. If another job saved the same entry
+    first, theirs is kept, since it has the same contents. Then the cache is
+    pruned back down to max_bytes (see prune_cache).
+    """
+    dirname = path.join(cache_dir, key)
+    tmp_dirname = "{}.{}.tmp".format(dirname, getpid())
+    makedirs(tmp_dirname, exist_ok=True)
+    for name, array in arrays.items():
+        np.save(path.join(tmp_dirname, name + ".npy"), array)
+    open(path.join(tmp_dirname, ENTRY_MARKER), "w").close()
+    try:
+        replace(tmp_dirname, dirname)
+    except OSError:
+        rmtree(tmp_dirname)
+    prune_cache(cache_dir, max_bytes, keep=[key])
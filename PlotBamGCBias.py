@@ -0,0 +1,239 @@
+""" Plot coverage against GC content, straight from BAMs and the reference FASTA
+
+This does the same as PlotGCBias.py, without bedtools makewindows, nuc and
+coverage making text files along the way. The FASTA is read once and its base
+counts are cached in small blocks, so that windows of any size that's a
+multiple of the block size can be put together from them without reading the
+genome again. Reads are counted in each window straight from the (indexed)
+BAMs, one chromosome at a time in parallel.
+"""
+
+import pysam
+import numpy as np
+from argparse import ArgumentParser
+from os import path
+from CountSNPASE import parse_chrom_sizes
+from ParseCache import MAX_CACHE_BYTES, cache_key, load_entry, save_entry
+from PlotGCBias import bin_windows, binned_total, plot_gc_biases
+from SharedPool import shared_pool, worker_state
+
+BLOCK_SIZE = 100
+
+# Only ParseCache entries go in here, so pruning it can't touch anything else
+DEFAULT_CACHE_DIR = path.join("analysis", "cache", "gc_blocks")
+
+# Class of every byte that could be in a sequence: 0 for A/T, 1 for G/C, 2 for N
+# and 3 for anything else, in either case
+BASE_CLASSES = np.full(256, 3, dtype=np.uint8)
+for bases, base_class in [("ATat", 0), ("GCgc", 1), ("Nn", 2)]:
+    BASE_CLASSES[np.frombuffer(bases.encode(), dtype=np.uint8)] = base_class
+
+
+def parse_args():
+    parser = ArgumentParser()
+    parser.add_argument("--step-size", "-s", default=1.0, type=float)
+    parser.add_argument("--output-dir", "-o", default=None)
+    parser.add_argument(
+        "--window-size",
+        "-w",
+        default=1000,
+        type=int,
+        help="Size of the windows (in bp) to compare GC content and coverage"
+        " in. Must be a multiple of {}".format(BLOCK_SIZE),
+    )
+    parser.add_argument(
+        "--chrom-sizes",
+        "-g",
+        default=None,
+        help="Only use the chromosomes in this chrom.sizes file (default: every"
+        " sequence in the FASTA)",
+    )
+    parser.add_argument(
+        "--threads",
+        "-t",
+        default=1,
+        type=int,
+        help="Number of chromosomes to count reads on at once",
+    )
+    parser.add_argument(
+        "--cache-dir",
+        default=DEFAULT_CACHE_DIR,
+        help="Where to cache the base counts of the reference (default:"
+        " %(default)s)."
+        " Once it holds more than {} GB, the least recently used entries are"
+        " removed".format(MAX_CACHE_BYTES // 2**30),
+    )
+    parser.add_argument("fasta")
+    parser.add_argument("bams", nargs="+")
+
+    args = parser.parse_args()
+
+    if args.window_size <= 0 or args.window_size % BLOCK_SIZE:
+        parser.error("--window-size must be a multiple of {}".format(BLOCK_SIZE))
+    if args.output_dir is None:
+        args.output_dir = path.dirname(args.bams[0])
+
+    return args
+
+
+def read_fasta(fname):
+    "Yield the name and sequence (as bytes) of each record in a FASTA file"
+    name, seq = None, []
+    for line in open(fname, "rb"):
+        if line.startswith(b">"):
+            if name is not None:
+                yield name, b"".join(seq)
+            name, seq = line[1:].split()[0].decode(), []
+        else:
+            seq.append(line.strip())
+    if name is not None:
+        yield name, b"".join(seq)
+
+
+def block_counts(seq, block_size=BLOCK_SIZE):
+    "Number of A/T, G/C, N and other bases in each block of a sequence"
+    num_blocks = -(-len(seq) // block_size)
+    classes = np.full(num_blocks * block_size, 4, dtype=np.uint8)
+    classes[: len(seq)] = BASE_CLASSES[np.frombuffer(seq, dtype=np.uint8)]
+    classes = classes.reshape(num_blocks, block_size)
+    return np.stack(
+        [(classes == base_class).sum(axis=1) for base_class in range(4)], axis=1
+    ).astype(np.int32)
+
+
+def fasta_blocks(fasta, cache_dir=None, block_size=BLOCK_SIZE):
+    """Base counts in each block of every sequence in a FASTA
+
+    Output: a dictionary with the names (chroms) and lengths of the sequences,
+    the index of each one's first block (offsets), and the number of A/T, G/C,
+    N and other bases in every block (counts). This is cached (see ParseCache),
+    so the FASTA only gets read once.
+    """
+    key = cache_key("fasta_blocks", [fasta], block_size=block_size)
+    blocks = load_entry(cache_dir, key)
+    if blocks is not None:
+        return blocks
+
+    chroms, lengths, counts = [], [], []
+    for name, seq in read_fasta(fasta):
+        chroms.append(name)
+        lengths.append(len(seq))
+        counts.append(block_counts(seq, block_size))
+    blocks = {
+        "chroms": np.array(chroms, dtype=bytes),
+        "lengths": np.array(lengths, dtype=np.int64),
+        "offsets": np.cumsum([0] + [len(chrom_counts) for chrom_counts in counts]),
+        "counts": np.concatenate(counts or [np.zeros((0, 4), dtype=np.int32)]),
+    }
+    if cache_dir is not None:
+        save_entry(cache_dir, key, blocks)
+    return blocks
+
+
+def genome_windows(blocks, window_size, chrom_sizes=None, block_size=BLOCK_SIZE):
+    """Windows across the genome, with their GC content
+
+    Like bedtools makewindows and then bedtools nuc: the last window on each
+    chromosome can be short, and frac_gc is out of all of the window's bases,
+    Ns included. chrom_sizes is a list of (chrom, size) pairs, to only use
+    (and order the windows by) those chromosomes.
+
+    Output: a dictionary of the windows' chrom, start, stop, seq_len and frac_gc,
+    as for PlotGCBias.bin_windows.
+    """
+    chroms = blocks["chroms"].astype(str).tolist()
+    if chrom_sizes is None:
+        chrom_sizes = zip(chroms, blocks["lengths"])
+    per_window = window_size // block_size
+
+    windows = {"chrom": [], "start": [], "stop": [], "seq_len": [], "gc": []}
+    for chrom, _ in chrom_sizes:
+        i = chroms.index(chrom)
+        length = blocks["lengths"][i]
+        counts = blocks["counts"][blocks["offsets"][i] : blocks["offsets"][i + 1]]
+        starts = np.arange(0, length, window_size)
+        stops = np.minimum(starts + window_size, length)
+        windows["chrom"].append(np.full(len(starts), chrom.encode()))
+        windows["start"].append(starts)
+        windows["stop"].append(stops)
+        windows["seq_len"].append(stops - starts)
+        windows["gc"].append(
+            np.add.reduceat(counts[:, 1], np.arange(0, len(counts), per_window))
+            if len(counts)
+            else np.zeros(0, dtype=np.int64)
+        )
+    windows = {
+        name: np.concatenate(values) if values else np.zeros(0)
+        for name, values in windows.items()
+    }
+    windows["frac_gc"] = windows.pop("gc") / windows["seq_len"]
+    return windows
+
+
+def read_spans(reads, chrom):
+    """Start and end of each mapped read on a chromosome, each sorted
+
+    Reads span from their first to their last aligned base, gaps and all, as
+    bedtools does without -split.
+    """
+    starts, ends = [], []
+    for read in reads.fetch(chrom):
+        if not read.is_unmapped:
+            starts.append(read.reference_start)
+            ends.append(read.reference_end)
+    starts = np.array(starts, dtype=np.int64)
+    ends = np.array(ends, dtype=np.int64)
+    return np.sort(starts), np.sort(ends)
+
+
+def window_read_counts(task):
+    """Number of reads overlapping each window on one chromosome of one BAM
+
+    Run in a pool from shared_pool, with the windows in worker_state. As with
+    bedtools coverage, a read counts in every window it overlaps.
+    """
+    bam_index, bam_fname, chrom = task
+    on_chrom = np.flatnonzero(worker_state["chrom"] == chrom.encode())
+    with pysam.AlignmentFile(bam_fname) as reads:
+        starts, ends = read_spans(reads, chrom)
+    overlapping = starts.searchsorted(
+        worker_state["stop"][on_chrom], side="left"
+    ) - ends.searchsorted(worker_state["start"][on_chrom], side="right")
+    return bam_index, on_chrom, overlapping
+
+
+def bam_coverage(bams, windows, threads=1):
+    """Reads per base in each window, for each of the BAMs
+
+    That's the number of reads overlapping the window over its length, which is
+    what used to come out of bedtools coverage and bioawk.
+    """
+    chroms = np.unique(windows["chrom"]).astype(str).tolist()
+    window_arrays = {name: windows[name] for name in ["chrom", "start", "stop"]}
+    tasks = [
+        (bam_index, bam_fname, chrom)
+        for bam_index, bam_fname in enumerate(bams)
+        for chrom in chroms
+    ]
+    read_counts = np.zeros((len(bams), len(windows["chrom"])))
+    with shared_pool(min(threads, len(tasks)), window_arrays) as pool:
+        for bam_index, rows, overlapping in pool.imap_unordered(
+            window_read_counts, tasks
+        ):
+            read_counts[bam_index, rows] = overlapping
+    return read_counts / (windows["seq_len"] + 1e-6)
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    blocks = fasta_blocks(args.fasta, args.cache_dir)
+    chrom_sizes = parse_chrom_sizes(args.chrom_sizes) if args.chrom_sizes else None
+    windows = bin_windows(
+        genome_windows(blocks, args.window_size, chrom_sizes), args.step_size
+    )
+
+    gc_covs = [
+        binned_total(windows, window_cov)
+        for window_cov in bam_coverage(args.bams, windows, args.threads)
+    ]
+    plot_gc_biases(windows, gc_covs, args.bams, args.output_dir)
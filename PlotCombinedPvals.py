@@ -27,11 +27,32 @@ from matplotlib.pyplot import (
     hlines,
     colorbar,
     tight_layout,
+    imshow,
+    gca,
+    gcf,
+    rcParams,
+    switch_backend,
 )
-from tqdm import tqdm
+from matplotlib.colors import to_rgba_array
+from ParseCache import MAX_CACHE_BYTES, cache_key, load_entry, save_entry
+from SharedPool import shared_pool, worker_state
 
 startswith = lambda y: lambda x: x.startswith(y)
 
+# Per-sample columns from ScoreSnps.py that CombinePvals.py keeps, and the ones
+# of them that are stored as int32, with -1 where a sample is missing a SNP
+FET_COLUMNS = [
+    "pval",
+    "stalk_ref",
+    "stalk_alt",
+    "spore_ref",
+    "spore_alt",
+    "stalk_ratio",
+    "spore_ratio",
+    "rank",
+]
+FET_INT_COLUMNS = {"stalk_ref", "stalk_alt", "spore_ref", "spore_alt", "rank"}
+
 
 def parse_args():
     "Program specific argument parsing"
@@ -47,34 +68,94 @@ def parse_args():
         help="Minimum number of samples to require for further analysis",
     )
     parser.add_argument("--autosomes", nargs="*")
+    parser.add_argument(
+        "--threads",
+        type=int,
+        default=1,
+        help="Number of figures to draw at once, each in its own process",
+    )
+    parser.add_argument(
+        "--cache-dir",
+        default=None,
+        help="Directory to cache the parsed scores table in (see CombinePvals.py)."
+        " Once it holds more than {} GB, the least recently used entries are"
+        " removed".format(MAX_CACHE_BYTES // 2**30),
+    )
     parser.add_argument("scores")
 
     parsed_args = parser.parse_args()
     return parsed_args
 
 
+def load_pval_table(fname, cache_dir=None):
+    "Read a combined .all.tsv table, from the parse cache if it's been seen before"
+    key = None
+    if cache_dir is not None:
+        key = cache_key("all_table", [fname])
+        cached = load_entry(cache_dir, key)
+        if cached is not None:
+            index = pd.Index(
+                cached["index"].astype(str), name=str(cached["index_name"]) or None
+            )
+            columns = cached["columns"].tolist()
+            return pd.DataFrame(
+                {column: cached[column] for column in columns}, index=index
+            )
+
+    pval_table = pd.read_table(fname, index_col=0)
+    if cache_dir is not None:
+        arrays = {column: pval_table[column].values for column in pval_table.columns}
+        arrays["index"] = np.array(pval_table.index, dtype=bytes)
+        arrays["index_name"] = np.array(pval_table.index.name or "")
+        arrays["columns"] = np.array(pval_table.columns, dtype=str)
+        save_entry(cache_dir, key, arrays)
+    return pval_table
+
+
+def snp_alleles(snp_ids):
+    """REF and ALT bases of SNPs, as categoricals
+
+    The ids can be full SNP ids (CHROM:POS_REF|ALT) or just the REF|ALT part.
+    There are only a handful of distinct REF|ALT pairs, so only those get split
+    apart, no matter how many SNPs there are.
+    """
+    pairs = pd.Categorical([snp.rsplit("_", 1)[-1] for snp in snp_ids])
+    alleles = []
+    for bases in zip(*(pair.split("|") for pair in pairs.categories)):
+        categories, codes = np.unique(bases, return_inverse=True)
+        alleles.append(pd.Categorical.from_codes(codes[pairs.codes], categories))
+    if not alleles:
+        alleles = [pd.Categorical([]), pd.Categorical([])]
+    return tuple(alleles)
+
+
+def base_in(bases, choices):
+    "Which of a categorical of bases are one of the choices"
+    return np.asarray(bases.categories.isin(list(choices)))[bases.codes]
+
+
 def gc_bias_change(score_table, min_samples=5):
-    out = {}
-    at = {"A", "T"}
-    gc = {"G", "C"}
-    score_table = score_table.loc[score_table.num_snps > min_samples]
-    for ix in tqdm(score_table.index):
-        row = score_table.loc[ix]
-        pre, post = ix.split("_")[-1].split("|")
-
-        if pre in at and post in gc:
-            change = -1
-        elif pre in gc and post in at:
-            change = 1
-        else:
-            change = 0
+    """How each SNP's alleles differ in GC content
 
-        if (row.stalk_ref_depth + row.spore_ref_depth) < (
-            row.stalk_alt_depth + row.spore_alt_depth
-        ):
-            change = -change
-        out[ix] = change
-    return pd.Series(out)
+    -1 if the reference is A/T and the alternate is G/C, 1 if the other way
+    around, 0 otherwise, with the sign flipped if there are more reads of the
+    alternate allele than of the reference.
+    """
+    score_table = score_table.loc[score_table.num_snps > min_samples]
+    ref, alt = snp_alleles(score_table.index)
+    change = np.select(
+        [
+            base_in(ref, "AT") & base_in(alt, "GC"),
+            base_in(ref, "GC") & base_in(alt, "AT"),
+        ],
+        [-1, 1],
+        0,
+    )
+    alt_favored = (
+        score_table.stalk_ref_depth + score_table.spore_ref_depth
+        < score_table.stalk_alt_depth + score_table.spore_alt_depth
+    ).values
+    return pd.Series(np.where(alt_favored, -change, change), index=score_table.index)
 
 
 def make_qq_plot(
@@ -103,6 +184,101 @@ def make_qq_plot(
     close()
 
 
+def chrom_runs(snps):
+    """Chromosome names and where each one's SNPs start, in sorted SNP ids
+
+    The ids are bytes, like in the FET store, so each chromosome is one run that
+    ends just before its name plus ";" (the character after ":").
+
+    Output: the chromosomes, in order, and the bounds of their runs.
+    """
+    chroms = []
+    bounds = [0]
+    while bounds[-1] < len(snps):
+        chrom = snps[bounds[-1]].split(b":", 1)[0]
+        chroms.append(chrom.decode())
+        bounds.append(int(snps.searchsorted(chrom + b";")))
+    return chroms, np.array(bounds)
+
+
+def binned_violin_stats(values, points=100, bins=4096):
+    """Statistics for Axes.violin, with a Gaussian KDE evaluated on a histogram
+
+    Uses the same Scott's rule bandwidth as violinplot, but the KDE costs the
+    same however many values there are, and the mean, median, and extremes are
+    still exact.
+    """
+    lo, hi = values.min(), values.max()
+    coords = np.linspace(lo, hi, points)
+    bandwidth = values.std(ddof=1) * len(values) ** (-1 / 5)
+    counts, edges = np.histogram(values, bins=bins, range=(lo, hi))
+    centers = (edges[:-1] + edges[1:]) / 2
+    kernel = np.exp(-0.5 * ((coords[:, None] - centers) / bandwidth) ** 2)
+    return dict(
+        coords=coords,
+        vals=kernel.dot(counts) / (len(values) * bandwidth * sqrt(2 * np.pi)),
+        mean=values.mean(),
+        median=np.median(values),
+        min=lo,
+        max=hi,
+    )
+
+
+def manhattan_violin(values, color, max_exact=10000):
+    "Violin of values, with a binned KDE once there are too many for the exact one"
+    if len(values) <= max_exact or values.min() == values.max():
+        result = violinplot(values, showextrema=False, showmedians=True)
+    else:
+        result = gca().violin(
+            [binned_violin_stats(values)], showextrema=False, showmedians=True
+        )
+    for body in result["bodies"]:
+        body.set_color(color)
+
+
+def manhattan_raster(x, ys, chrom_codes, color_tables, dots_per_unit, dot_size=4):
+    """Bin points into an RGBA image, as round dots colored by chromosome
+
+    dots_per_unit is how many dots fit in one unit of x and of y on the plot,
+    and each dot is dot_size pixels across. Each of ys is drawn in turn with its
+    own table of chromosome colors, so later ones win where they overlap. Pixels
+    with no points are clear.
+
+    Output: the image, and its extent for imshow.
+    """
+    pad = dot_size // 2
+    finite = [isfinite(y) for y in ys]
+    y_lo = min((y[ok].min() for y, ok in zip(ys, finite) if ok.any()), default=0)
+    y_hi = max((y[ok].max() for y, ok in zip(ys, finite) if ok.any()), default=1)
+    if y_hi <= y_lo:
+        y_hi = y_lo + 1
+    x_lo, x_hi = -0.5, max(len(x), 1) - 0.5
+    width = max(1, int(ceil((x_hi - x_lo) * dots_per_unit[0]))) * dot_size
+    height = max(1, int(ceil((y_hi - y_lo) * dots_per_unit[1]))) * dot_size
+    dx = (x_hi - x_lo) / width
+    dy = (y_hi - y_lo) / height
+
+    offsets = np.arange(dot_size) - pad
+    drow, dcol = np.meshgrid(offsets, offsets, indexing="ij")
+    center = (dot_size - 1) / 2 - pad
+    in_dot = (drow - center) ** 2 + (dcol - center) ** 2 <= (dot_size / 2) ** 2
+
+    # Index into the palette for each pixel, where 0 is clear
+    palette = np.concatenate([np.zeros((1, 4)), *color_tables])
+    pixels = np.zeros((height + 2 * pad, width + 2 * pad), dtype=np.int32)
+    col = pad + ((x - x_lo) / dx).astype(int).clip(0, width - 1)
+    first_color = 1
+    for y, ok, colors in zip(ys, finite, color_tables):
+        row = pad + ((y[ok] - y_lo) / dy).astype(int).clip(0, height - 1)
+        color = first_color + chrom_codes[ok]
+        for row_offset, col_offset in zip(drow[in_dot], dcol[in_dot]):
+            pixels[row + row_offset, col[ok] + col_offset] = color
+        first_color += len(colors)
+
+    extent = (x_lo - pad * dx, x_hi + pad * dx, y_lo - pad * dy, y_hi + pad * dy)
+    return palette[pixels], extent
+
+
 def make_manhattan_plot(
     spore_pvals,
     stalk_pvals,
@@ -113,61 +289,122 @@ def make_manhattan_plot(
     label="-log10 p",
     autosomes=[],
     violin=False,
+    scatter_above=None,
 ):
-    spore_pvals = spore_pvals.sort_index()
-    stalk_pvals = stalk_pvals.sort_index()
+    """Spore p-values up and stalk p-values down, along the genome
+
+    There are far too many SNPs to draw one at a time, so only the ones beyond
+    scatter_above (in -log10 p; by default, the Bonferroni cutoff if there is
+    one, otherwise none of them) are drawn as points. The rest are binned into
+    a raster at about the size of a point.
+    """
+    if not stalk_pvals.index.equals(spore_pvals.index):
+        stalk_pvals = stalk_pvals.reindex(spore_pvals.index)
+    # Sorting the ids as bytes is several times faster than as objects
+    snps = np.array(spore_pvals.index, dtype=bytes)
+    order = snps.argsort(kind="mergesort")
+    snps = snps[order]
+    spore_pvals = spore_pvals.values[order]
+    stalk_pvals = stalk_pvals.values[order]
     translator = {}
     if path.exists(translation):
         for line in open(translation):
             line = line.strip().split()
             translator[line[0]] = line[1]
-    chrom_of = np.array([x.split(":")[0] for x in stalk_pvals.index])
+    chroms, bounds = chrom_runs(snps)
     if autosomes:
         print("Before: ", len(spore_pvals))
-        on_autosome = [x in autosomes or translator[x] in autosomes for x in chrom_of]
-        spore_pvals = spore_pvals.ix[on_autosome]
-        stalk_pvals = stalk_pvals.ix[on_autosome]
-        chrom_of = chrom_of[on_autosome]
+        is_autosome = [x in autosomes or translator[x] in autosomes for x in chroms]
+        on_autosome = np.repeat(is_autosome, np.diff(bounds)).astype(bool)
+        snps = snps[on_autosome]
+        spore_pvals = spore_pvals[on_autosome]
+        stalk_pvals = stalk_pvals[on_autosome]
+        chroms, bounds = chrom_runs(snps)
         print("After: ", len(spore_pvals))
-    chroms = sorted(set(chrom_of))
-    reds = ["red", "darkred", "pink"]
-    blues = ["blue", "darkblue", "lightblue"]
-    chroms_colors_red = {ix: reds[i % len(reds)] for i, ix in enumerate(chroms)}
-    chroms_colors_blue = {ix: blues[i % len(blues)] for i, ix in enumerate(chroms)}
+    # Colors go by each chromosome's place in name order
+    chrom_rank = np.argsort(np.argsort(chroms, kind="mergesort"))
+    chrom_codes = np.repeat(chrom_rank, np.diff(bounds)).astype(int)
+    reds = to_rgba_array(["red", "darkred", "pink"])
+    blues = to_rgba_array(["blue", "darkblue", "lightblue"])
+    chroms_colors_red = reds[np.arange(len(chroms)) % len(reds)]
+    chroms_colors_blue = blues[np.arange(len(chroms)) % len(blues)]
 
     plot_kwargs = {"s": 1}
-    x = arange(len(stalk_pvals))
+    x = arange(len(snps))
+    with np.errstate(divide="ignore", invalid="ignore"):
+        spore_y = -log10(spore_pvals)
+        stalk_y = log10(stalk_pvals)
 
     chrom_midpoints = {
-        x[[(i == chrom) for i in chrom_of]].mean(): translator.get(chrom, chrom)
-        for chrom in chroms
+        (start + stop - 1) / 2: translator.get(chrom, chrom)
+        for chrom, start, stop in zip(chroms, bounds, bounds[1:])
     }
 
+    bonferroni = -log10(0.05 / (len(x) + 1e-6))
+    if scatter_above is None:
+        scatter_above = bonferroni if plot_bonferroni else np.inf
+    spore_points = spore_y > scatter_above
+    stalk_points = -stalk_y > scatter_above
+
     figure()
     if violin:
         subplot2grid((1, 5), (0, 0), colspan=4)
-    scatter(
+    # How many dots fit in one unit of x and y, once the axes are scaled to fit
+    # everything, where a dot is the size of a scatter point with its edge
+    dot_size = (sqrt(plot_kwargs["s"]) + rcParams["lines.linewidth"]) / 72
+    width, height = gca().get_window_extent().size / gcf().dpi / dot_size
+    y_all = np.concatenate(
+        [spore_y, stalk_y, [-bonferroni, bonferroni] if plot_bonferroni else []]
+    )
+    y_all = y_all[isfinite(y_all)]
+    y_span = (np.ptp(y_all) if len(y_all) else 0) or 1
+    dots_per_unit = (
+        width / (max(len(x) - 1, 1) * (1 + 2 * rcParams["axes.xmargin"])),
+        height / (y_span * (1 + 2 * rcParams["axes.ymargin"])),
+    )
+    image, extent = manhattan_raster(
         x,
-        -log10(spore_pvals.sort_index()),
-        label="Spore",
-        c=[chroms_colors_red[ix] for ix in chrom_of],
+        [
+            np.where(spore_points, np.nan, spore_y),
+            np.where(stalk_points, np.nan, stalk_y),
+        ],
+        chrom_codes,
+        [chroms_colors_red, chroms_colors_blue],
+        dots_per_unit,
+    )
+    raster = imshow(
+        image,
+        extent=extent,
+        origin="lower",
+        aspect="auto",
+        interpolation="nearest",
+    )
+    # Leave the usual margins around the points, like a scatter plot would
+    raster.sticky_edges.x[:] = []
+    raster.sticky_edges.y[:] = []
+    # Legend entries for the rasterized points
+    scatter([], [], label="Spore", c=[chroms_colors_red[0]], **plot_kwargs)
+    scatter([], [], label="Stalk", c=[chroms_colors_blue[0]], **plot_kwargs)
+    scatter(
+        x[spore_points],
+        spore_y[spore_points],
+        c=chroms_colors_red[chrom_codes[spore_points]],
         **plot_kwargs,
     )
     scatter(
-        x,
-        log10(stalk_pvals.sort_index()),
-        label="Stalk",
-        c=[chroms_colors_blue[ix] for ix in chrom_of],
+        x[stalk_points],
+        stalk_y[stalk_points],
+        c=chroms_colors_blue[chrom_codes[stalk_points]],
         **plot_kwargs,
     )
     if plot_bonferroni:
         hlines(
-            [log10(.05 / (len(x) + 1e-6)), -log10(.05 / (len(x) + 1e-6))],
+            [-bonferroni, bonferroni],
             0,
             len(x),
             "k",
             linestyles="dashed",
-            lw=.5,
+            lw=0.5,
         )
     ticks = yticks()[0]
     yticks(ticks, np.abs(ticks))
@@ -177,20 +414,8 @@ def make_manhattan_plot(
 
     if violin:
         subplot2grid((1, 5), (0, 4))
-        result = violinplot(
-            list(filter(isfinite, -log10(spore_pvals))),
-            showextrema=False,
-            showmedians=True,
-        )
-        for body in result["bodies"]:
-            body.set_color("r")
-        result = violinplot(
-            list(filter(isfinite, log10(stalk_pvals))),
-            showextrema=False,
-            showmedians=True,
-        )
-        for body in result["bodies"]:
-            body.set_color("b")
+        manhattan_violin(spore_y[isfinite(spore_y)], "r")
+        manhattan_violin(stalk_y[isfinite(stalk_y)], "b")
         xticks([])
         yticks(ticks, np.abs(ticks))
 
@@ -230,6 +455,44 @@ def make_tehranchigram(
     close()
 
 
+def load_fet_store(dirname):
+    """Memory-map the per-sample FET results saved by CombinePvals.py
+
+    Output: a dictionary with the sorted SNP ids, the sample names, and one
+    SNP x sample array for each of the FET_COLUMNS. Nothing but the sample
+    names is actually read until it's used.
+    """
+    store = {"samples": np.load(path.join(dirname, "samples.npy")).tolist()}
+    for name in ["snps", *FET_COLUMNS]:
+        store[name] = np.load(path.join(dirname, name + ".npy"), mmap_mode="r")
+    return store
+
+
+def fet_store_rows(store, snps):
+    "Find the rows of the given SNP ids in a FET results store"
+    snps = np.array(snps, dtype=bytes)
+    rows = store["snps"].searchsorted(snps)
+    found = store["snps"][np.minimum(rows, len(store["snps"]) - 1)] == snps
+    if not found.all():
+        raise KeyError("SNPs not in FET results: {}".format(snps[~found]))
+    return rows
+
+
+def top_snps(dataset, count):
+    """The count SNPs with the smallest values, in order
+
+    Only those SNPs get sorted, after a partial selection of them from the
+    rest, rather than sorting the whole dataset. NaNs come last.
+    """
+    values = np.asarray(dataset.values, dtype=float)
+    count = min(count, len(values))
+    if 0 < count < len(values):
+        top = np.argpartition(values, count - 1)[:count]
+    else:
+        top = np.arange(count)
+    return dataset.iloc[top[np.argsort(values[top], kind="mergesort")]]
+
+
 def plot_top_snps(
     dataset,
     name,
@@ -242,87 +505,58 @@ def plot_top_snps(
 ):
     """Plot stalk/spore frequencies of top SNPs
 
-    Each SNP gets its own window, with one point per sample.
+    Each SNP gets its own window, with one point per sample. The dataset
+    doesn't need to be sorted, since the top SNPs are picked out of it with
+    top_snps. The per-sample data for all of them comes from a FET results
+    store (see load_fet_store) in one read per column, and every panel is drawn
+    from those SNP x sample matrices.
     """
     n_rows = int(ceil(sqrt(num_snps_to_plot)))
     n_cols = num_snps_to_plot // n_rows
     assert n_rows * n_cols >= num_snps_to_plot
 
+    top = top_snps(dataset, num_snps_to_plot)
+    rows = fet_store_rows(all_fet_data, top.index)
+    top_data = {
+        column: np.asarray(all_fet_data[column][rows])
+        for column in [
+            "stalk_ratio",
+            "spore_ratio",
+            "stalk_ref",
+            "stalk_alt",
+            "spore_ref",
+            "spore_alt",
+        ]
+    }
+    has_alt = (top_data["stalk_alt"] + top_data["spore_alt"]) > 0
+    if show_ebars:
+        spore_ref = top_data["spore_ref"] + ebar_pseudocount
+        stalk_ref = top_data["stalk_ref"] + ebar_pseudocount
+        spore_alt = top_data["spore_alt"] + ebar_pseudocount
+        stalk_alt = top_data["stalk_alt"] + ebar_pseudocount
+        spore_sum = spore_ref + spore_alt
+        stalk_sum = stalk_ref + stalk_alt
+        spore_e = sqrt(
+            1 / spore_sum * (spore_ref / spore_sum) * (spore_alt / spore_sum)
+        )
+        stalk_e = sqrt(
+            1 / stalk_sum * (stalk_ref / stalk_sum) * (stalk_alt / stalk_sum)
+        )
+    num_samples = num_snps.loc[top.index].values
+
     figure(figsize=(16, 12))
 
-    for i in range(num_snps_to_plot):
-        snp = dataset.index[i]
+    for i, (snp, value) in enumerate(top.items()):
         ax = subplot(n_rows, n_cols, i + 1)
-        title("{}\n{} samples - {:3.1e}".format(snp, num_snps[snp], dataset.loc[snp]))
-        stalks = [
-            all_fet_data[file].loc[snp, "stalk_ratio"]
-            for file in all_fet_data
-            if (
-                all_fet_data[file].loc[snp, "stalk_alt"]
-                + all_fet_data[file].loc[snp, "spore_alt"]
-            )
-            > 0
-        ]
-        spores = [
-            all_fet_data[file].loc[snp, "spore_ratio"]
-            for file in all_fet_data
-            if (
-                all_fet_data[file].loc[snp, "stalk_alt"]
-                + all_fet_data[file].loc[snp, "spore_alt"]
-            )
-            > 0
-        ]
+        title("{}\n{} samples - {:3.1e}".format(snp, num_samples[i], value))
+        sel = has_alt[i]
+        stalks = top_data["stalk_ratio"][i][sel]
+        spores = top_data["spore_ratio"][i][sel]
         scatter(stalks, spores)
         if show_ebars:
-            spore_ref = (
-                np.array(
-                    [
-                        df.loc[snp, "spore_ref"]
-                        for df in all_fet_data.values()
-                        if df.loc[snp, "stalk_alt"] + df.loc[snp, "spore_alt"] > 0
-                    ]
-                )
-                + ebar_pseudocount
-            )
-            stalk_ref = (
-                np.array(
-                    [
-                        df.loc[snp, "stalk_ref"]
-                        for df in all_fet_data.values()
-                        if df.loc[snp, "stalk_alt"] + df.loc[snp, "spore_alt"] > 0
-                    ]
-                )
-                + ebar_pseudocount
-            )
-            spore_alt = (
-                np.array(
-                    [
-                        df.loc[snp, "spore_alt"]
-                        for df in all_fet_data.values()
-                        if df.loc[snp, "stalk_alt"] + df.loc[snp, "spore_alt"] > 0
-                    ]
-                )
-                + ebar_pseudocount
+            errorbar(
+                stalks, spores, 0.5 * stalk_e[i][sel], 0.5 * spore_e[i][sel], fmt="."
             )
-            stalk_alt = (
-                np.array(
-                    [
-                        df.loc[snp, "stalk_alt"]
-                        for df in all_fet_data.values()
-                        if df.loc[snp, "stalk_alt"] + df.loc[snp, "spore_alt"] > 0
-                    ]
-                )
-                + ebar_pseudocount
-            )
-            spore_sum = spore_ref + spore_alt
-            stalk_sum = stalk_ref + stalk_alt
-            spore_e = sqrt(
-                1 / spore_sum * (spore_ref / spore_sum) * (spore_alt / spore_sum)
-            )
-            stalk_e = sqrt(
-                1 / stalk_sum * (stalk_ref / stalk_sum) * (stalk_alt / stalk_sum)
-            )
-            errorbar(stalks, spores, .5 * stalk_e, .5 * spore_e, fmt=".")
         plot([0, 1], [0, 1], "r:")
         ax.set_aspect(1)
         xlim(-0.1, 1.1)
@@ -343,11 +577,123 @@ def plot_top_snps(
     close()
 
 
+# Every figure that main draws, slowest first so the pool finishes soonest
+FIGURES = ["coverage", "manhattan", "gc_bias", "qq", "num_snps"]
+
+
+def shared_pval_table():
+    "Rebuild the scores table from the arrays shared with a figure worker"
+    return pd.DataFrame(
+        {column: worker_state[column] for column in worker_state["columns"]},
+        index=pd.Index(worker_state["snps"].astype(str), name="snp_id"),
+    )
+
+
+def autosome_mask(index, autosomes, translator):
+    "Which SNPs are on one of the autosomes (by name or translated name)"
+    if not autosomes:
+        return np.ones(len(index), dtype=bool)
+    return np.array(
+        [
+            chrom in autosomes or translator[chrom] in autosomes
+            for chrom in (x.split(":")[0] for x in index)
+        ],
+        dtype=bool,
+    )
+
+
+def render_figure(name):
+    """Draw one of the FIGURES, in a worker from render_figures
+
+    Output: what to print about it.
+    """
+    switch_backend("Agg")
+    pval_table_orig = shared_pval_table()
+    outdir = worker_state["outdir"]
+    autosomes = worker_state["autosomes"]
+    min_samples = worker_state["min_samples"]
+    pval_table = pval_table_orig.loc[pval_table_orig.num_snps > min_samples]
+    on_autosome = autosome_mask(pval_table.index, autosomes, worker_state["translator"])
+    autosome_table = pval_table.loc[on_autosome]
+
+    if name == "num_snps":
+        figure()
+        hist(
+            pval_table_orig.num_snps,
+            density=True,
+            bins=np.arange(1, max(pval_table_orig.num_snps)),
+        )
+        hist(autosome_table.num_snps, density=True, histtype="step")
+        savefig("{}num_snps.png".format(outdir))
+        close("all")
+        return "Number of samples histogram"
+
+    elif name == "qq":
+        make_qq_plot(
+            autosome_table.spore.dropna().sort_values(),
+            autosome_table.stalk.dropna().sort_values(),
+            autosome_table.random.dropna().sort_values(),
+            outdir=outdir,
+        )
+        return "QQ Plot"
+
+    elif name == "manhattan":
+        make_manhattan_plot(
+            autosome_table.spore.dropna(),
+            autosome_table.stalk.dropna(),
+            outdir=outdir,
+            autosomes=autosomes,
+        )
+        close("all")
+        return "GWAS Manhattan"
+
+    elif name == "coverage":
+        make_manhattan_plot(
+            (autosome_table.spore_ref_depth + autosome_table.spore_alt_depth).dropna(),
+            (autosome_table.stalk_ref_depth + autosome_table.stalk_alt_depth).dropna(),
+            outdir=outdir,
+            label="log10 coverage",
+            fname="coverage",
+            plot_bonferroni=False,
+            autosomes=autosomes,
+            violin=True,
+        )
+        close("all")
+        return "Coverage Manhattan"
+
+    elif name == "gc_bias":
+        res = gc_bias_change(pval_table, min_samples=min_samples)
+        return "\n".join(
+            [
+                "Estimating effect of GC Bias on SNP recovery",
+                "SNPs that increase GC {}".format(sum(res == -1)),
+                "SNPs that increase AT {}".format(sum(res == 1)),
+                "SNPs that don't change AT/GC {}".format(sum(res == 0)),
+            ]
+        )
+
+    raise ValueError("Unknown figure {}".format(name))
+
+
+def render_figures(pval_table, threads=1, **options):
+    """Draw all of the FIGURES, each in its own worker process
+
+    The table goes in shared memory, so every worker reads the same copy, and
+    the figures are drawn on the Agg backend. With enough threads, this takes
+    as long as the slowest figure rather than all of them together.
+    """
+    arrays = {column: pval_table[column].values for column in pval_table.columns}
+    arrays["snps"] = np.array(pval_table.index, dtype=bytes)
+    with shared_pool(
+        min(threads, len(FIGURES)), arrays, columns=list(pval_table.columns), **options
+    ) as pool:
+        for message in pool.imap_unordered(render_figure, FIGURES):
+            print(message)
+
+
 if __name__ == "__main__":
     args = parse_args()
-    pval_table = pd.read_table(args.scores, index_col=0)
-    pval_table_orig = pval_table.copy()
-    pval_table = pval_table.loc[pval_table.num_snps > args.min_samples]
+    pval_table = load_pval_table(args.scores, args.cache_dir)
 
     outdir = (
         args.output_prefix + "/"
@@ -356,83 +702,16 @@ if __name__ == "__main__":
     )
 
     translator = {}
-    translation = "Reference/chrom_names.txt"
-
     if args.translation is not None:
         for line in open(args.translation):
             line = line.strip().split()
             translator[line[0]] = line[1]
 
-    combined_pvals_stalk = pval_table.stalk
-    combined_pvals_spore = pval_table.spore
-    combined_pvals_rand = pval_table.random
-
-    stalk_ref_depth = pval_table.stalk_ref_depth
-    spore_ref_depth = pval_table.spore_ref_depth
-    stalk_alt_depth = pval_table.stalk_alt_depth
-    spore_alt_depth = pval_table.spore_alt_depth
-
-    stalk_depth = stalk_ref_depth + stalk_alt_depth
-    spore_depth = spore_ref_depth + spore_alt_depth
-
-    chrom_of = np.array([x.split(":")[0] for x in pval_table_orig.index])
-
-    autosomes = args.autosomes
-    if args.autosomes:
-        print("Before: ", len(combined_pvals_spore))
-        on_autosome = [
-            ix
-            for ix, x in zip(combined_pvals_spore.index, chrom_of)
-            if x in autosomes or translator[x] in autosomes
-        ]
-        combined_pvals_spore = combined_pvals_spore.loc[on_autosome].dropna()
-        combined_pvals_stalk = combined_pvals_stalk.loc[on_autosome].dropna()
-        combined_pvals_rand = combined_pvals_rand.loc[on_autosome].dropna()
-        spore_depth = spore_depth.loc[on_autosome].dropna()
-        stalk_depth = stalk_depth.loc[on_autosome].dropna()
-        print("After: ", len(combined_pvals_spore))
-
-    hist(
-        pval_table_orig.num_snps,
-        density=True,
-        bins=np.arange(1, max(pval_table_orig.num_snps)),
-    )
-    hist(pval_table_orig.num_snps.loc[on_autosome], density=True, histtype="step")
-    savefig("{}num_snps.png".format(outdir))
-    close()
-
-    print("QQ Plot")
-    make_qq_plot(
-        combined_pvals_spore.sort_values(),
-        combined_pvals_stalk.sort_values(),
-        combined_pvals_rand.sort_values(),
-        outdir=outdir,
-    )
-
-    # make_tehranchigram(all_stalk_freqs, all_spore_freqs)
-
-    print("GWAS Manhattan")
-    make_manhattan_plot(
-        combined_pvals_spore,
-        combined_pvals_stalk,
+    render_figures(
+        pval_table,
+        threads=args.threads,
         outdir=outdir,
         autosomes=args.autosomes,
+        translator=translator,
+        min_samples=args.min_samples,
     )
-
-    print("Coverage Manhattan")
-    make_manhattan_plot(
-        spore_depth,
-        stalk_depth,
-        outdir=outdir,
-        label="log10 coverage",
-        fname="coverage",
-        plot_bonferroni=False,
-        autosomes=args.autosomes,
-        violin=True,
-    )
-
-    print("Estimating effect of GC Bias on SNP recovery")
-    res = gc_bias_change(pval_table, min_samples=args.min_samples)
-    print("SNPs that increase GC", sum(res == -1))
-    print("SNPs that increase AT", sum(res == 1))
-    print("SNPs that don't change AT/GC", sum(res == 0))
@@ -1,8 +1,17 @@
+""" Plot coverage against GC content, for each of a set of coverage files
+
+Each coverage bed has one line per window, with the same windows as the
+bedtools nuc table in the gc file. Windows are put into GC bins once (and
+cached in --cache-dir), and then each coverage file is just a weighted bincount
+over those bins.
+"""
+
 import numpy as np
 import pandas as pd
 from argparse import ArgumentParser
 from os import path
 from matplotlib.pyplot import (
+    close,
     scatter,
     hlines,
     xlim,
@@ -15,6 +24,8 @@ from matplotlib.pyplot import (
     xlabel,
     ylabel,
 )
+from ParseCache import MAX_CACHE_BYTES, cache_key, load_entry, save_entry
+from SharedPool import shared_pool, worker_state
 
 GC_COLS = [
     "chr",
@@ -33,6 +44,9 @@ GC_COLS = [
 
 COV_COLS = ["Chrom", "start", "stop", "cov"]
 
+# Only ParseCache entries go in here, so pruning it can't touch anything else
+DEFAULT_CACHE_DIR = path.join("analysis", "cache", "gc_bins")
+
 
 def longest_common_suffix(list_of_strings):
     reversed_strings = ["".join(s[::-1]) for s in list_of_strings]
@@ -45,6 +59,20 @@ def parse_args():
     parser = ArgumentParser()
     parser.add_argument("--step-size", "-s", default=1.0, type=float)
     parser.add_argument("--output-dir", "-o", default=None)
+    parser.add_argument(
+        "--threads",
+        "-t",
+        default=1,
+        type=int,
+        help="Number of coverage files to read at once",
+    )
+    parser.add_argument(
+        "--cache-dir",
+        default=DEFAULT_CACHE_DIR,
+        help="Where to cache the GC bins of the windows (default: %(default)s)."
+        " Once it holds more than {} GB, the least recently used entries are"
+        " removed".format(MAX_CACHE_BYTES // 2**30),
+    )
     parser.add_argument("gc_file")
     parser.add_argument("window_coverage_bed", nargs="+")
 
@@ -64,65 +92,156 @@ def step_ceil(value, stepsize):
     return stepsize * np.ceil(value / stepsize)
 
 
-if __name__ == "__main__":
-    args = parse_args()
-    gc = pd.read_csv(
-        args.gc_file, index_col=[0, 1, 2], names=GC_COLS, header=0, sep="\t"
+def bin_windows(windows, step_size=1.0):
+    """Add GC bins to a dictionary of windows with their frac_gc
+
+    The bins are step_size percent wide, and gc_steps has their left edges. Each
+    window's bin is -1 if its GC content is unknown. As it always has been, the
+    top bin is left empty (so it plots as NaN), and the windows in it or past
+    its left edge aren't counted.
+    """
+    frac_gc = np.asarray(windows["frac_gc"])
+    gc_low = step_floor(np.nanmin(frac_gc), step_size / 100)
+    gc_high = step_ceil(np.nanmax(frac_gc), step_size / 100)
+    gc_steps = np.arange(gc_low, gc_high, step_size / 100)
+    bins = np.digitize(frac_gc, gc_steps) - 1
+    bins[~np.isfinite(frac_gc) | (bins >= len(gc_steps) - 1)] = -1
+    return dict(windows, gc_steps=gc_steps, bin=bins)
+
+
+def gc_bins(gc_file, step_size=1.0, cache_dir=None):
+    """Which GC bin each window in a bedtools nuc table falls in
+
+    Output: a dictionary with the windows' chrom, start, stop, seq_len and
+    frac_gc, the left edges of the GC bins (gc_steps), and the bin of each
+    window (-1 if it isn't counted). This is cached in cache_dir, if it's given
+    (see ParseCache), so each gc file only gets read and binned once per step
+    size.
+    """
+    # Entries from before the top bin was left empty again have it filled in
+    key = cache_key("gc_bins", [gc_file], step_size=step_size, top_bin="empty")
+    windows = load_entry(cache_dir, key)
+    if windows is not None:
+        return windows
+
+    gc = pd.read_csv(gc_file, names=GC_COLS, header=0, sep="\t", dtype={"chr": str})
+    windows = bin_windows(
+        {
+            "chrom": np.array(gc.chr, dtype=bytes),
+            "start": gc.start.values,
+            "stop": gc.stop.values,
+            "seq_len": gc.seq_len.values,
+            "frac_gc": gc.frac_gc.values,
+        },
+        step_size,
     )
-    gc_low = step_floor(gc.frac_gc.min(), args.step_size / 100)
-    gc_high = step_ceil(gc.frac_gc.max(), args.step_size / 100)
-    gc_steps = np.arange(gc_low, gc_high, args.step_size / 100)
+    if cache_dir is not None:
+        save_entry(cache_dir, key, windows)
+    return windows
+
+
+def window_rows(windows, chrom, start, stop):
+    "Which of the windows each line of a coverage bed is (-1 if none of them)"
+    if (
+        len(chrom) == len(windows["chrom"])
+        and np.array_equal(chrom, windows["chrom"])
+        and np.array_equal(start, windows["start"])
+        and np.array_equal(stop, windows["stop"])
+    ):
+        return np.arange(len(chrom))
+    window_index = pd.MultiIndex.from_arrays(
+        [windows["chrom"], windows["start"], windows["stop"]]
+    )
+    return window_index.get_indexer(pd.MultiIndex.from_arrays([chrom, start, stop]))
+
+
+def binned_total(windows, values):
+    "Sum of the values for the windows in each GC bin"
+    in_bin = windows["bin"] >= 0
+    return np.bincount(
+        windows["bin"][in_bin],
+        weights=values[in_bin],
+        minlength=len(windows["gc_steps"]),
+    )
+
+
+def coverage_by_gc(cov_file):
+    """Total coverage in each GC bin for one coverage bed
+
+    Run in a pool from shared_pool, with the output of gc_bins in worker_state.
+    Windows that aren't in the coverage bed count as having no coverage.
+    """
+    cov = pd.read_csv(
+        cov_file, header=None, names=COV_COLS, sep="\t", dtype={"Chrom": str}
+    )
+    rows = window_rows(
+        worker_state,
+        np.array(cov.Chrom, dtype=bytes),
+        cov.start.values,
+        cov.stop.values,
+    )
+    window_cov = np.zeros(len(worker_state["bin"]))
+    window_cov[rows[rows >= 0]] = cov["cov"].values[rows >= 0]
+    return binned_total(worker_state, window_cov)
+
 
-    common_path = path.commonprefix(args.window_coverage_bed)
-    common_suffix = longest_common_suffix(args.window_coverage_bed)
+def plot_gc_bias(gc_steps, normed_cov, plotname, outdir):
+    "Add one file's normalized coverage to the summary, and give it its own plot"
+    figure(1)
+    subplot(2, 1, 1)
+    scatter(gc_steps * 100, normed_cov, s=4, label=plotname)
+    figure()
+    hlines(1, gc_steps.min() * 100, gc_steps.max() * 100, "k", linestyles="dotted")
+    scatter(gc_steps * 100, normed_cov, label=plotname)
+    ylabel("Normed Coverage")
+    xlabel("% GC")
+    savefig(path.join(outdir, "{}_gc_cov_normed.png".format(plotname)), dpi=300)
+    close()
+
+
+def plot_gc_biases(windows, gc_covs, fnames, outdir):
+    """Plot the normalized coverage in each GC bin for every file
+
+    gc_covs has the total coverage in each of the windows' GC bins for each of
+    the files, which are named in the plots by what's unique to each fname.
+    """
+    gc_steps = np.asarray(windows["gc_steps"])
+    total_len = binned_total(windows, windows["seq_len"])
+
+    common_path = path.commonprefix(fnames)
+    common_suffix = longest_common_suffix(fnames)
     print("---->", common_suffix)
 
-    outdir = args.output_dir
-    for cov_file in args.window_coverage_bed:
-        cov = pd.read_csv(
-            cov_file, header=None, names=COV_COLS, index_col=[0, 1, 2], sep="\t"
-        )
-        # total_cov = sum(gc["seq_len"] * cov["cov"])
-        gc_cov = pd.Series(index=gc_steps, data=np.nan)
-        total_len = pd.Series(index=gc_steps, data=np.nan)
-
-        for bin_lo, bin_hi in zip(gc_cov.index, gc_cov.index[1:]):
-            try:
-                q = gc.query("{} <= frac_gc < {}".format(bin_lo, bin_hi))
-                gc_cov[bin_lo] = sum(cov.loc[q.index, "cov"])
-                total_len[bin_lo] = sum(q["seq_len"])
-            except KeyError:
-                gc_cov[bin_lo] = 0
-                total_len[bin_lo] = sum(q["seq_len"])
-
-        y = gc_cov / total_len
-
-        figure(1, figsize=(8, 6))
-        subplot(2, 1, 1)
-        plotname = cov_file.replace(common_path, "").replace(common_suffix, "")
+    figure(1, figsize=(8, 6))
+    for fname, gc_cov in zip(fnames, gc_covs):
+        with np.errstate(invalid="ignore", divide="ignore"):
+            y = gc_cov / total_len
+        plotname = fname.replace(common_path, "").replace(common_suffix, "")
         print(plotname)
-        scatter(gc_cov.index * 100, y / y.mean(), s=4, label=plotname)
-        figure()
-        hlines(
-            1,
-            gc_cov.index.min() * 100,
-            gc_cov.index.max() * 100,
-            "k",
-            linestyles="dotted",
-        )
-        scatter(gc_cov.index * 100, y / y.mean(), label=plotname)
-        ylabel("Normed Coverage")
-        xlabel("% GC")
-        savefig(path.join(outdir, "{}_gc_cov_normed.png".format(plotname)), dpi=300)
+        plot_gc_bias(gc_steps, y / np.nanmean(y), plotname, outdir)
+
+    plot_summary(windows, outdir)
 
+
+def plot_summary(windows, outdir):
+    "Finish off the plot of every file's coverage, over the windows' GC content"
+    gc_steps = windows["gc_steps"]
     figure(1)
-    hlines(
-        1, gc_cov.index.min() * 100, gc_cov.index.max() * 100, "k", linestyles="dotted"
-    )
+    hlines(1, gc_steps.min() * 100, gc_steps.max() * 100, "k", linestyles="dotted")
     ylabel("Normed Coverage")
     legend()
     subplot(2, 1, 2)
-    hist(gc.frac_gc * 100, bins=gc_steps * 100)
+    hist(windows["frac_gc"] * 100, bins=gc_steps * 100)
     xlabel("% GC")
     ylabel("Density")
-    savefig(path.join(args.output_dir, "gc_cov_normed.png"), dpi=300)
+    savefig(path.join(outdir, "gc_cov_normed.png"), dpi=300)
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    windows = gc_bins(args.gc_file, args.step_size, args.cache_dir)
+
+    with shared_pool(min(args.threads, len(args.window_coverage_bed)), windows) as pool:
+        gc_covs = pool.map(coverage_by_gc, args.window_coverage_bed)
+
+    plot_gc_biases(windows, gc_covs, args.window_coverage_bed, args.output_dir)
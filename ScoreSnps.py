@@ -1,108 +1,452 @@
 """ Come up with a ranking of SNPs within each fruiting body
 
 Use Fishers Exact Test to come up with a ranking of SNPs within each Stalk/Spore
-pair.
+pair. Any number of fruiting bodies can be scored in one run with --pair, either
+from count tables, or from a single count matrix made by CountSNPASE.py.
 
 I am not putting too much stock in these p-values as meaningful, so later
 steps in the pipeline will effectively just use the rank order.
 
 """
+import numpy as np
 import pandas as pd
+from array import array
 from argparse import ArgumentParser
-from tqdm import tqdm
+from os import path, makedirs, replace, getpid
 from sys import stderr
-from scipy.stats import fisher_exact
-from multiprocessing import Pool
-from collections import defaultdict
+from scipy.special import gammaln
+from CountSNPASE import load_count_matrix
+from SharedPool import shared_pool, worker_state
 
 
-def pipesplit(col):
-    return lambda input: input.split("|")[col]
+def snpcount_records(fname):
+    """Yield (chr, pos), ref, alt, refbase, altbase from a SNP count table
 
-
-base_cols = {"A": 0, "C": 1, "G": 2, "T": 3}
-
-
-def read_snpcounts(fname):
-    outdict = {}
+    Raises ValueError if the file isn't sorted by (CHROM, POS), which the
+    streaming merge depends on.
+    """
+    last_key = None
     with open(fname) as fh:
         next(fh)  # Skip header
         for line in fh:
             chr, pos, refbase, altbase, ref, alt, nonra = line.split()
-            outdict[(chr, int(pos))] = [int(ref), int(alt), refbase, altbase]
-    return outdict
+            key = chr, int(pos)
+            if last_key is not None and key <= last_key:
+                raise ValueError(
+                    "{} is not sorted by CHROM and POS at {}:{}".format(fname, *key)
+                )
+            last_key = key
+            yield key, int(ref), int(alt), refbase, altbase
+
+
+def merge_snpcounts(stalk_fname, spore_fname):
+    """Stream-merge the stalk and spore count tables on (CHROM, POS)
+
+    Both tables are sorted the same way, so this only ever holds one line of
+    each in memory, and collects the SNPs in both straight into typed arrays.
+
+    Output: Dictionary of arrays, one entry per SNP, with the chromosome (as an
+    index into "chroms"), position, stalk and spore counts, and the REF and ALT
+    bases from the spore table.
+    """
+    chroms = []
+    chrom_ids = {}
+    columns = {
+        "chrom": array("H"),
+        "pos": array("l"),
+        "stalk_ref": array("l"),
+        "stalk_alt": array("l"),
+        "spore_ref": array("l"),
+        "spore_alt": array("l"),
+    }
+    refbases = []
+    altbases = []
+
+    stalks = snpcount_records(stalk_fname)
+    spores = snpcount_records(spore_fname)
+    stalk = next(stalks, None)
+    spore = next(spores, None)
+    while stalk is not None and spore is not None:
+        if stalk[0] < spore[0]:
+            stalk = next(stalks, None)
+        elif spore[0] < stalk[0]:
+            spore = next(spores, None)
+        else:
+            (chr, pos), stalk_ref, stalk_alt, _, _ = stalk
+            _, spore_ref, spore_alt, refbase, altbase = spore
+            if chr not in chrom_ids:
+                chrom_ids[chr] = len(chroms)
+                chroms.append(chr)
+            columns["chrom"].append(chrom_ids[chr])
+            columns["pos"].append(pos)
+            columns["stalk_ref"].append(stalk_ref)
+            columns["stalk_alt"].append(stalk_alt)
+            columns["spore_ref"].append(spore_ref)
+            columns["spore_alt"].append(spore_alt)
+            refbases.append(refbase)
+            altbases.append(altbase)
+            stalk = next(stalks, None)
+            spore = next(spores, None)
+
+    out = {
+        col: np.frombuffer(values, dtype=values.typecode)
+        for col, values in columns.items()
+    }
+    out["chroms"] = np.array(chroms)
+    out["refbase"] = np.array(refbases)
+    out["altbase"] = np.array(altbases)
+    return out
+
+
+def log_choose(n, k):
+    "Natural log of the binomial coefficient n choose k"
+    return gammaln(n + 1) - gammaln(k + 1) - gammaln(n - k + 1)
+
+
+def fisher_exact_onesided(stalk_ref, stalk_alt, spore_ref, spore_alt, max_cells=2**20):
+    """One-sided Fisher's Exact Test on many 2x2 tables at once
+
+    Each table is [[stalk_ref, stalk_alt], [spore_ref, spore_alt]]. The p-value
+    is half of the two-sided p-value if the odds ratio is greater than 1, and 1
+    minus that otherwise, just as we used to do with scipy's fisher_exact.
+
+    The two-sided p-value is the sum of the hypergeometric probabilities of all
+    tables with the same margins that are no more likely than the observed one.
+    Tables are grouped by the size of their support, and each group is done as a
+    single (tables x support) array of probabilities, in blocks of no more than
+    max_cells.
+    """
+    a = np.asarray(stalk_ref, dtype=np.int64)
+    b = np.asarray(stalk_alt, dtype=np.int64)
+    c = np.asarray(spore_ref, dtype=np.int64)
+    d = np.asarray(spore_alt, dtype=np.int64)
+    n1 = a + b
+    n2 = c + d
+    n = a + c
+    lo = np.maximum(0, n - n2)
+    width = np.minimum(n1, n) - lo + 1
+
+    # Tables with an empty row or column only have one possible arrangement,
+    # so they get a two-sided p-value of 1 (and an undefined odds ratio)
+    pvals = np.ones(len(a))
+    testable = (n1 > 0) & (n2 > 0) & (n > 0) & (b + d > 0)
+
+    # Same relative tolerance that scipy (as of 1.2) uses to decide whether a
+    # table is as extreme as the observed one
+    log_tolerance = -np.log1p(-1e-4)
+
+    bucket = np.ceil(np.log2(width)).astype(int)
+    for bucket_size in np.unique(bucket[testable]):
+        num_cols = 2**bucket_size
+        block_size = max(1, max_cells // num_cols)
+        in_bucket = np.flatnonzero(testable & (bucket == bucket_size))
+        for start in range(0, len(in_bucket), block_size):
+            ix = in_bucket[start : start + block_size]
+            x = lo[ix, None] + np.arange(num_cols)
+            in_support = x < (lo[ix] + width[ix])[:, None]
+            x = np.where(in_support, x, lo[ix, None])
+            log_denom = log_choose(n1[ix] + n2[ix], n[ix])[:, None]
+            log_pmf = (
+                log_choose(n1[ix, None], x)
+                + log_choose(n2[ix, None], n[ix, None] - x)
+                - log_denom
+            )
+            log_pobs = (
+                log_choose(n1[ix], a[ix]) + log_choose(n2[ix], c[ix]) - log_denom[:, 0]
+            )
+            as_extreme = in_support & (log_pmf <= log_pobs[:, None] + log_tolerance)
+            pvals[ix] = np.where(as_extreme, np.exp(log_pmf), 0).sum(axis=1)
+    pvals = np.minimum(pvals, 1)
+
+    ref_in_stalk = testable & (a * d > b * c)
+    return np.where(ref_in_stalk, pvals / 2, 1 - pvals / 2)
+
+
+def fisher_exact_block(block):
+    "One-sided Fisher's Exact Test on a slice of the pool's tables, in a worker"
+    start, stop = block
+    return fisher_exact_onesided(*worker_state["tables"][start:stop].T)
+
+
+def parallel_fisher_exact_onesided(tables, threads=1):
+    """One-sided Fisher's Exact Test on (N, 4) tables, spread over a pool
+
+    The tables go in shared memory, and each worker tests a slice of them.
+    There are a few slices per worker, so that one slow slice (of very deep
+    tables) doesn't hold the rest up.
+    """
+    if threads <= 1 or len(tables) < threads:
+        return fisher_exact_onesided(*tables.T)
+    bounds = np.linspace(0, len(tables), 4 * threads + 1).astype(int)
+    with shared_pool(threads, dict(tables=tables)) as pool:
+        pvals = pool.map(fisher_exact_block, zip(bounds, bounds[1:]))
+    return np.concatenate(pvals)
+
+
+def pack_tables(tables):
+    "Pack (N, 4) tables of counts below 2**15 into one int64 key per table"
+    tables = np.asarray(tables, dtype=np.int64)
+    return (
+        (tables[:, 0] << 48)
+        | (tables[:, 1] << 32)
+        | (tables[:, 2] << 16)
+        | tables[:, 3]
+    )
+
+
+def load_pval_cache(fname):
+    """Load the on-disk cache of already computed p-values
+
+    Output: Dictionary with the sorted, packed tables ("keys"), their p-values,
+    the generation each entry was last used in, and the current generation,
+    which is one more than the newest entry.
+    """
+    if fname is None or not path.exists(fname):
+        return dict(
+            keys=np.zeros(0, dtype=np.int64),
+            pvals=np.zeros(0),
+            last_used=np.zeros(0, dtype=np.int64),
+            generation=0,
+        )
+    data = np.load(fname)
+    return dict(
+        keys=data["keys"],
+        pvals=data["pvals"],
+        last_used=data["last_used"],
+        generation=int(data["last_used"].max(initial=-1)) + 1,
+    )
+
+
+def save_pval_cache(fname, cache, max_entries=1000000):
+    """Save the p-value cache, keeping only the most recently used entries
+
+    The cache is written to a temporary file and then moved into place, so that
+    several jobs sharing a cache can't corrupt it (though the last one to finish
+    wins).
+    """
+    keep = np.argsort(cache["last_used"], kind="mergesort")[-max_entries:]
+    keep.sort()
+    if path.dirname(fname):
+        makedirs(path.dirname(fname), exist_ok=True)
+    tmp_fname = "{}.{}.tmp".format(fname, getpid())
+    with open(tmp_fname, "wb") as outfh:
+        np.savez(
+            outfh,
+            keys=cache["keys"][keep],
+            pvals=cache["pvals"][keep],
+            last_used=cache["last_used"][keep],
+        )
+    replace(tmp_fname, fname)
+
+
+def cached_fisher_exact_onesided(
+    stalk_ref,
+    stalk_alt,
+    spore_ref,
+    spore_alt,
+    cache=None,
+    max_cache_depth=200,
+    threads=1,
+):
+    """One-sided Fisher's Exact Test, only testing each distinct table once
+
+    Most SNPs have low coverage, so the same handful of tables come up over and
+    over. Each distinct table is looked up in the cache (if given), and the
+    rest are computed with fisher_exact_onesided on threads workers. Newly
+    computed tables with no more than max_cache_depth total reads get added to
+    the cache.
+    """
+    tables = np.column_stack([stalk_ref, stalk_alt, spore_ref, spore_alt])
+    unique_tables, inverse = np.unique(tables, axis=0, return_inverse=True)
+    inverse = inverse.reshape(-1)
+    pvals = np.full(len(unique_tables), np.nan)
+
+    if cache is not None:
+        cacheable = (unique_tables.sum(axis=1) <= max_cache_depth) & (
+            unique_tables.max(axis=1) < 2**15
+        )
+        keys = pack_tables(unique_tables[cacheable])
+        ix = cache["keys"].searchsorted(keys).clip(0, len(cache["keys"]) - 1)
+        if len(cache["keys"]):
+            in_cache = cache["keys"][ix] == keys
+        else:
+            in_cache = np.zeros(len(keys), dtype=bool)
+        pvals[np.flatnonzero(cacheable)[in_cache]] = cache["pvals"][ix[in_cache]]
+        cache["last_used"][ix[in_cache]] = cache["generation"]
+
+    to_test = np.isnan(pvals)
+    pvals[to_test] = parallel_fisher_exact_onesided(unique_tables[to_test], threads)
+
+    if cache is not None:
+        new_keys = keys[~in_cache]
+        keys = np.concatenate([cache["keys"], new_keys])
+        order = np.argsort(keys, kind="mergesort")
+        cache["keys"] = keys[order]
+        cache["pvals"] = np.concatenate(
+            [cache["pvals"], pvals[np.flatnonzero(cacheable)[~in_cache]]]
+        )[order]
+        cache["last_used"] = np.concatenate(
+            [
+                cache["last_used"],
+                np.full(len(new_keys), cache["generation"], dtype=np.int64),
+            ]
+        )[order]
+
+    return pvals[inverse]
 
 
 def parse_args():
     "Parse command line arguments"
     parser = ArgumentParser()
-    parser.add_argument("stalk_count")
-    parser.add_argument("spore_count")
-    parser.add_argument("output")
+    parser.add_argument(
+        "--pval-cache",
+        default=None,
+        help="File of p-values for previously seen low-depth tables, which is"
+        " shared across runs and samples",
+    )
+    parser.add_argument(
+        "--cache-max-depth",
+        type=int,
+        default=200,
+        help="Only cache tables with no more than this many reads in total",
+    )
+    parser.add_argument(
+        "--cache-size",
+        type=int,
+        default=1000000,
+        help="Maximum number of tables to keep in the p-value cache",
+    )
+    parser.add_argument("--threads", "-t", type=int, default=1)
+    parser.add_argument(
+        "--pair",
+        nargs=3,
+        action="append",
+        default=[],
+        metavar=("STALK", "SPORE", "OUTPUT"),
+        help="Score another fruiting body in the same run. Can be given as many"
+        " times as needed.",
+    )
+    parser.add_argument(
+        "--matrix",
+        default=None,
+        help="SNP x library count matrix from CountSNPASE.py. If given, the"
+        " stalk and spore counts are library names in the matrix, rather than"
+        " count tables.",
+    )
+    parser.add_argument("stalk_count", nargs="?")
+    parser.add_argument("spore_count", nargs="?")
+    parser.add_argument("output", nargs="?")
 
     args = parser.parse_args()
-    args.stalk_count = read_snpcounts(args.stalk_count)
-    args.spore_count = read_snpcounts(args.spore_count)
+    if args.output is not None:
+        args.pair.insert(0, [args.stalk_count, args.spore_count, args.output])
+    elif args.stalk_count is not None:
+        parser.error("Need a stalk count, a spore count, and an output file")
+    if not args.pair:
+        parser.error("Nothing to score")
     return args
 
 
-if __name__ == "__main__":
-    args = parse_args()
+def matrix_snpcounts(matrix, stalk, spore):
+    """Get the per-SNP arrays for one fruiting body from a count matrix
 
-    in_both = set(args.stalk_count).intersection(args.spore_count)
-    out_pvals = {}
-    out_stalk_ref = {}
-    out_stalk_alt = {}
-    out_spore_ref = {}
-    out_spore_alt = {}
-    out_refbase = {}
-    out_altbase = {}
-    pool = Pool(8)
-    print("Starting Fisher Exact Tests", file=stderr)
-    for pos in tqdm(in_both):
-        table = [
-            [args.stalk_count[pos][0], args.stalk_count[pos][1]],
-            [args.spore_count[pos][0], args.spore_count[pos][1]],
-        ]
-        snpid = "{}:{:07d}_{}|{}".format(
-            *pos, args.spore_count[pos][2], args.spore_count[pos][3]
+    Output: The same dictionary of arrays as merge_snpcounts. Every SNP in the
+    matrix was counted in every library, so there's nothing to join.
+    """
+    if "chrom" not in matrix:
+        matrix["chroms"], matrix["chrom"] = np.unique(
+            matrix["CHROM"], return_inverse=True
         )
-        out_pvals[snpid] = pool.apply_async(fisher_exact, [table])
-        out_stalk_ref[snpid] = args.stalk_count[pos][0]
-        out_stalk_alt[snpid] = args.stalk_count[pos][1]
-        out_spore_ref[snpid] = args.spore_count[pos][0]
-        out_spore_alt[snpid] = args.spore_count[pos][1]
-
-    print("Getting Fisher Exact Pvalues", file=stderr)
-    for id in tqdm(out_pvals):
-        odds_r, pval = out_pvals[id].get()
-        if odds_r > 1:
-            out_pvals[id] = pval / 2
-        else:
-            out_pvals[id] = 1 - pval / 2
+    stalk = matrix["libraries"].index(stalk)
+    spore = matrix["libraries"].index(spore)
+    return dict(
+        chroms=matrix["chroms"],
+        chrom=matrix["chrom"],
+        pos=matrix["POS"],
+        stalk_ref=matrix["counts"][:, stalk, 0].astype(np.int64),
+        stalk_alt=matrix["counts"][:, stalk, 1].astype(np.int64),
+        spore_ref=matrix["counts"][:, spore, 0].astype(np.int64),
+        spore_alt=matrix["counts"][:, spore, 1].astype(np.int64),
+        refbase=matrix["REF_BASE"],
+        altbase=matrix["ALT_BASE"],
+    )
+
+
+def score_snps(snps, pval_cache=None, max_cache_depth=200, threads=1):
+    """Test and rank the SNPs from one fruiting body
+
+    Takes a dictionary of per-SNP arrays, as from merge_snpcounts, and returns
+    the scores table, sorted by p-value.
+    """
+    pvals = cached_fisher_exact_onesided(
+        snps["stalk_ref"],
+        snps["stalk_alt"],
+        snps["spore_ref"],
+        snps["spore_alt"],
+        cache=pval_cache,
+        max_cache_depth=max_cache_depth,
+        threads=threads,
+    )
+
+    # The SNPs are already in position order, so a stable sort breaks ties in
+    # p-value by position
+    order = np.argsort(pvals, kind="mergesort")
+    snpids = [
+        "{}:{:07d}_{}|{}".format(chr, pos, refbase, altbase)
+        for chr, pos, refbase, altbase in zip(
+            snps["chroms"][snps["chrom"][order]].tolist(),
+            snps["pos"][order].tolist(),
+            snps["refbase"][order].tolist(),
+            snps["altbase"][order].tolist(),
+        )
+    ]
     out = pd.DataFrame(
         {
-            "pval": out_pvals,
-            "stalk_ref": out_stalk_ref,
-            "stalk_alt": out_stalk_alt,
-            "spore_ref": out_spore_ref,
-            "spore_alt": out_spore_alt,
-        }
+            "pval": pvals[order],
+            "stalk_ref": snps["stalk_ref"][order],
+            "stalk_alt": snps["stalk_alt"][order],
+            "spore_ref": snps["spore_ref"][order],
+            "spore_alt": snps["spore_alt"][order],
+        },
+        index=pd.Index(snpids, name="snp_id"),
     )
-    out["stalk_ratio"] = out.stalk_alt / (out.stalk_alt + out.stalk_ref)
-    out["spore_ratio"] = out.spore_alt / (out.spore_alt + out.spore_ref)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        out["stalk_ratio"] = out.stalk_alt / (out.stalk_alt + out.stalk_ref)
+        out["spore_ratio"] = out.spore_alt / (out.spore_alt + out.spore_ref)
 
-    out.index.name = "snp_id"
-    print("Updating ranks", file=stderr)
-    out = out.sort_values(by="pval")
-    out["rank"] = -1
-    i = 0
-    min_vals = out.loc[:, ["stalk_alt", "stalk_ref", "spore_alt", "spore_ref"]].min(
-        axis=1
+    min_vals = np.min(
+        [out.stalk_alt, out.stalk_ref, out.spore_alt, out.spore_ref], axis=0
     )
-    min_vals_pass = min_vals.index[min_vals >= 2]
-    out.loc[min_vals_pass, "rank"] = 1 + pd.np.arange(len(min_vals_pass))
+    min_vals_pass = min_vals >= 2
+    out["rank"] = -1
+    out.loc[min_vals_pass, "rank"] = 1 + np.arange(min_vals_pass.sum())
+    out["maxrank"] = 1 + min_vals_pass.sum()
+    return out
+
+
+if __name__ == "__main__":
+    args = parse_args()
+
+    matrix = None
+    if args.matrix is not None:
+        print("Loading count matrix", file=stderr)
+        matrix = load_count_matrix(args.matrix)
+
+    pval_cache = None
+    if args.pval_cache is not None:
+        pval_cache = load_pval_cache(args.pval_cache)
+    elif len(args.pair) > 1:
+        # Still share tables between fruiting bodies within this run
+        pval_cache = load_pval_cache(None)
+
+    for stalk, spore, output in args.pair:
+        print("Scoring", output, file=stderr)
+        if matrix is None:
+            snps = merge_snpcounts(stalk, spore)
+        else:
+            snps = matrix_snpcounts(matrix, stalk, spore)
+        out = score_snps(snps, pval_cache, args.cache_max_depth, args.threads)
+        out.to_csv(output, sep="\t", float_format="%5e")
 
-    out["maxrank"] = 1 + len(min_vals_pass)
-    print("Writing Output File", file=stderr)
-    out.to_csv(args.output, sep="\t", float_format="%5e")
+    if args.pval_cache is not None:
+        save_pval_cache(args.pval_cache, pval_cache, args.cache_size)
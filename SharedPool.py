@@ -0,0 +1,57 @@
+""" Worker pools that share big arrays with their workers
+
+Arguments to Pool.map and friends get pickled and sent to a worker for every
+task, which for a whole table of SNPs costs more than the work itself. Instead,
+the arrays a pool needs are copied once into shared memory when the pool
+starts, and every worker gets a read-only numpy view of them, in worker_state,
+without copying anything.
+
+With only one thread, there's no point in any of that, so the work is done on
+a single thread in this process, looking at the original arrays.
+"""
+
+from multiprocessing import Pool
+from multiprocessing.pool import ThreadPool
+from multiprocessing.sharedctypes import RawArray
+import numpy as np
+
+worker_state = {}
+
+
+def to_shared(array):
+    """Copy an array into shared memory
+
+    Output: the shared buffer, along with the dtype and shape to view it as.
+    """
+    array = np.ascontiguousarray(array)
+    raw = RawArray("b", max(array.nbytes, 1))
+    from_shared(raw, array.dtype.str, array.shape)[...] = array
+    return raw, array.dtype.str, array.shape
+
+
+def from_shared(raw, dtype, shape):
+    "A numpy view of an array that to_shared put in shared memory"
+    return np.frombuffer(raw, dtype=dtype, count=int(np.prod(shape))).reshape(shape)
+
+
+def init_worker(arrays, shared, state):
+    "Set up worker_state with the pool's arrays and any other (small) state"
+    worker_state.clear()
+    worker_state.update(state)
+    for name, array in arrays.items():
+        if shared:
+            array = from_shared(*array)
+            array.flags.writeable = False
+        worker_state[name] = array
+
+
+def shared_pool(threads, arrays, **state):
+    """A pool of workers that can all see the arrays and state in worker_state
+
+    arrays is a dictionary of numpy arrays, which get put in shared memory, and
+    everything else is pickled once for each worker.
+    """
+    if threads > 1:
+        arrays = {name: to_shared(array) for name, array in arrays.items()}
+        return Pool(threads, init_worker, (arrays, True, state))
+    return ThreadPool(1, init_worker, (arrays, False, state))
@@ -0,0 +1,46 @@
+""" Split a bed file of SNPs by how they change GC content
+
+The name column of each line has the REF|ALT bases, as from VCF_to_Bed.py.
+SNPs from A/T to G/C go in one file, from G/C to A/T in another, and those
+that stay A/T or stay G/C in a third; anything else (like an N) goes nowhere.
+"""
+
+from argparse import ArgumentParser
+import pandas as pd
+from PlotCombinedPvals import snp_alleles, base_in
+
+
+def parse_args():
+    parser = ArgumentParser()
+    parser.add_argument("snps", help="Bed file of SNPs, with REF|ALT as the name")
+    parser.add_argument("--more", required=True, help="Where to put AT -> GC SNPs")
+    parser.add_argument("--less", required=True, help="Where to put GC -> AT SNPs")
+    parser.add_argument(
+        "--same", required=True, help="Where to put AT -> AT and GC -> GC SNPs"
+    )
+    return parser.parse_args()
+
+
+def read_bed(fname):
+    "Read a bed file's lines as text, so they're written back out unchanged"
+    try:
+        return pd.read_csv(
+            fname, sep="\t", header=None, dtype=str, keep_default_na=False
+        )
+    except pd.errors.EmptyDataError:
+        return pd.DataFrame(columns=range(4), dtype=str)
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    snps = read_bed(args.snps)
+    ref, alt = snp_alleles(snps[3])
+    ref_at, ref_gc = base_in(ref, "AT"), base_in(ref, "GC")
+    alt_at, alt_gc = base_in(alt, "AT"), base_in(alt, "GC")
+
+    for fname, which in [
+        (args.more, ref_at & alt_gc),
+        (args.less, ref_gc & alt_at),
+        (args.same, (ref_at & alt_at) | (ref_gc & alt_gc)),
+    ]:
+        snps.loc[which].to_csv(fname, sep="\t", header=False, index=False)